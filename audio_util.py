@@ -0,0 +1,675 @@
+"""In-process audio engine: decodes songs to PCM and resamples them block by block according to the current speed,
+so that a speed change is audible after at most one block (ENGINE_BLOCK_MS) instead of going through mplayer's pipe.
+Like mplayer's speed_set (without scaletempo) this changes tempo and pitch together, which is what a Leierkasten does.
+
+Needs numpy. Decoding uses the stdlib's wave module for 16 bit wav files and ffmpeg for everything else, output goes
+to ALSA (pyalsaaudio) if it is installed, else to a NullSink that just keeps the pace. With a PcmCache every song is
+only decoded once, after that it is played straight from a memory-mapped file. With a VariantCache on top, songs are
+additionally pre-rendered at a few quantised speeds, so that playing them needs no resampling at all.
+"""
+
+import hashlib
+import mmap
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from time import monotonic, sleep
+
+import numpy as np
+
+from library_util import lower_priority
+from mplayer_util import Player, media_file_filter
+from settings import ENGINE_BLOCK_MS, ENGINE_SAMPLE_RATE, ENGINE_SINK, PCM_CACHE_DIR, PCM_CACHE_BUDGET_MB, \
+    ENGINE_SPEED_VARIANTS, ENGINE_VARIANT_TOLERANCE, PCM_VARIANT_DIR, PCM_VARIANT_BUDGET_MB, VARIANT_WORKERS
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+CHANNELS = 2
+
+
+# Decoders - read_frames(n) returns up to n frames as int16 array of shape (n, CHANNELS), empty at the end.
+# Decoders that have the whole song in memory instead set `frames` to that array, so it is never copied.
+##########################################################################
+
+
+class WavDecoder():
+    frames = None
+
+    def __init__(self, path):
+        self._wav = wave.open(path, "rb")
+        if self._wav.getsampwidth() != 2:
+            self._wav.close()
+            raise ValueError(f"{path} is not 16 bit")
+        self.sample_rate = self._wav.getframerate()
+        self._channels = self._wav.getnchannels()
+
+    def read_frames(self, n):
+        samples = np.frombuffer(self._wav.readframes(n), dtype=np.int16).reshape(-1, self._channels)
+        if self._channels == 1:
+            samples = np.repeat(samples, CHANNELS, axis=1)
+        return samples[:, :CHANNELS]
+
+    def close(self):
+        self._wav.close()
+
+
+class FfmpegDecoder():
+    frames = None
+
+    def __init__(self, path, sample_rate=ENGINE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._process = subprocess.Popen(
+            ["ffmpeg", "-v", "quiet", "-i", path, "-f", "s16le", "-ac", str(CHANNELS), "-ar", str(sample_rate), "-"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        )
+
+    def read_frames(self, n):
+        data = self._process.stdout.read(n * CHANNELS * 2)
+        data = data[:len(data) - len(data) % (CHANNELS * 2)]
+        return np.frombuffer(data, dtype=np.int16).reshape(-1, CHANNELS)
+
+    def close(self):
+        self._process.kill()
+        self._process.wait()
+
+
+def open_decoder(path):
+    if path.lower().endswith(".wav"):
+        try:
+            return WavDecoder(path)
+        except (ValueError, wave.Error):
+            pass
+    return FfmpegDecoder(path)
+
+
+# PCM cache
+##########################################################################
+
+PCM_MAGIC = b"LKPCM\x01"
+PCM_HEADER = struct.Struct("<6sIHQ")  # magic, sample rate, channels, frames
+PCM_HEADER_SIZE = 32  # the header is padded, so that the samples are aligned
+
+
+class MmapDecoder():
+    """A song from the PcmCache: the memory-mapped file is the frames-array, nothing is decoded or copied. read_frames
+    returns views of it, like every other decoder from the start to the end."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as rfile:
+            self._mmap = mmap.mmap(rfile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.sample_rate, channels, n_frames = PCM_HEADER.unpack_from(self._mmap)
+        if magic != PCM_MAGIC or channels != CHANNELS:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a valid PCM cache file")
+        self.frames = np.frombuffer(self._mmap, dtype="<i2", count=n_frames * CHANNELS,
+                                    offset=PCM_HEADER_SIZE).reshape(-1, CHANNELS)
+        self._pos = 0
+
+    def read_frames(self, n):
+        frames = self.frames[self._pos:self._pos + n]
+        self._pos += len(frames)
+        return frames
+
+    def close(self):
+        self.frames = None  # the mmap can only be closed once no array refers to it anymore
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # still used by the engine's buffer, closed when that is garbage collected
+
+
+def write_pcm(path, chunks, sample_rate):
+    """writes the int16 frame-arrays of chunks into a PCM cache file at path, which only appears once it's complete"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    n_frames = 0
+    try:
+        with open(tmp_path, "wb") as wfile:
+            wfile.write(bytes(PCM_HEADER_SIZE))
+            for frames in chunks:
+                wfile.write(frames.astype("<i2").tobytes())
+                n_frames += len(frames)
+            wfile.seek(0)
+            wfile.write(PCM_HEADER.pack(PCM_MAGIC, sample_rate, CHANNELS, n_frames))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def evict_lru(directory, budget_bytes, keep=None):
+    """removes the least recently used PCM files in directory until it fits into the budget"""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".pcm") and entry.path != keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(i[1] for i in entries) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(entries):
+        if total <= budget_bytes:
+            break
+        os.remove(path)  # if it is playing right now, its mmap stays valid until it is closed
+        total -= size
+
+
+class PcmCache():
+    """Decodes every song once into a raw PCM file (PCM_HEADER + interleaved int16) in `directory`, keyed on the song's
+    path, mtime and size. Uses at most `budget_bytes` of disk, least recently played songs are evicted first (a file's
+    mtime is its last use). Decoding happens in one background thread, so that the Pi's CPU is not fighting over it."""
+
+    def __init__(self, directory=PCM_CACHE_DIR, budget_bytes=PCM_CACHE_BUDGET_MB * 1024 ** 2):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._queue = Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_path(self, path):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf8")).hexdigest() + ".pcm")
+
+    def open(self, path):
+        """the cached song if there is one, else a decoder for the original, while it gets cached for next time"""
+        cache_path = self.cache_path(path)
+        if os.path.exists(cache_path):
+            try:
+                decoder = MmapDecoder(cache_path)
+            except (ValueError, OSError) as e:
+                print(f"Broken PCM cache file for {path}: {e}", file=sys.stderr)
+                os.remove(cache_path)
+            else:
+                os.utime(cache_path)
+                self.hits += 1
+                return decoder
+        self.misses += 1
+        self.prefetch(path)
+        return open_decoder(path)
+
+    def prefetch(self, path):
+        """decode path into the cache in the background, if it is not in there already"""
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+        self._queue.put(path)
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            try:
+                if not os.path.exists(self.cache_path(path)):
+                    self.decode(path)
+            except Exception as e:
+                print(f"Could not cache {path}: {e}", file=sys.stderr)
+            with self._lock:
+                self._queued.discard(path)
+
+    def decode(self, path):
+        cache_path = self.cache_path(path)
+        decoder = open_decoder(path)
+
+        def chunks():
+            while len(frames := decoder.read_frames(65536)):
+                yield frames
+
+        try:
+            write_pcm(cache_path, chunks(), decoder.sample_rate)
+        finally:
+            decoder.close()
+        evict_lru(self.directory, self.budget_bytes, keep=cache_path)
+        return cache_path
+
+
+# Pre-rendered speed variants
+##########################################################################
+
+
+def render_variant(source_path, target_path, step, sample_rate):
+    """resamples the PCM cache file at source_path, reading `step` source frames per written frame, into target_path.
+    Runs in the worker processes of the VariantCache."""
+    source = MmapDecoder(source_path)
+    frames = source.frames
+    n_out = int((len(frames) - 1) / step)
+
+    def chunks():
+        for start in range(0, n_out, 65536):
+            positions = np.arange(start, min(start + 65536, n_out)) * step
+            index = positions.astype(np.intp)
+            frac = (positions - index)[:, None]
+            yield np.round(frames[index] * (1 - frac) + frames[index + 1] * frac)
+
+    try:
+        write_pcm(target_path, chunks(), sample_rate)
+    finally:
+        del frames
+        source.close()
+
+
+class VariantCache():
+    """Renders every song of a PcmCache at the quantised `speeds`, in the background in a pool of worker processes,
+    into `directory`. Like the PcmCache it uses at most `budget_bytes` and evicts the least recently used files first.
+    The AudioEngine then plays the variant closest to the wanted speed by just copying its frames. on_rendered is
+    called with (source_cache_path, speed, variant_path) from the pool's thread whenever a variant is finished."""
+
+    def __init__(self, pcm_cache, speeds=ENGINE_SPEED_VARIANTS, directory=PCM_VARIANT_DIR,
+                 budget_bytes=PCM_VARIANT_BUDGET_MB * 1024 ** 2, workers=VARIANT_WORKERS,
+                 sample_rate=ENGINE_SAMPLE_RATE):
+        self.pcm_cache = pcm_cache
+        self.speeds = sorted(speeds)
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.sample_rate = sample_rate
+        os.makedirs(directory, exist_ok=True)
+        self._pool = ProcessPoolExecutor(max_workers=workers, initializer=lower_priority)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.on_rendered = None
+
+    def variant_path(self, source_cache_path, speed):
+        return os.path.join(self.directory, f"{os.path.basename(source_cache_path)[:-len('.pcm')]}@{speed:g}.pcm")
+
+    def open(self, source_cache_path, source_rate):
+        """{speed: MmapDecoder} of the variants of the song in the PcmCache file source_cache_path that are rendered
+        already, the others are rendered now. The source itself is the variant for speed 1 if it has the engine's sample
+        rate, so that one is not rendered."""
+        decoders = {}
+        for speed in self.speeds:
+            if speed == 1 and source_rate == self.sample_rate:
+                continue
+            variant_path = self.variant_path(source_cache_path, speed)
+            if os.path.exists(variant_path):
+                try:
+                    decoders[speed] = MmapDecoder(variant_path)
+                    os.utime(variant_path)
+                    continue
+                except (ValueError, OSError) as e:
+                    print(f"Broken variant {variant_path}: {e}", file=sys.stderr)
+                    os.remove(variant_path)
+            self._render(source_cache_path, variant_path, speed, speed * source_rate / self.sample_rate)
+        return decoders
+
+    def _render(self, source_path, variant_path, speed, step):
+        with self._lock:
+            if variant_path in self._pending:
+                return
+            self._pending.add(variant_path)
+        future = self._pool.submit(render_variant, source_path, variant_path, step, self.sample_rate)
+        future.add_done_callback(lambda f: self._rendered(source_path, speed, variant_path, f))
+
+    def _rendered(self, source_path, speed, variant_path, future):
+        with self._lock:
+            self._pending.discard(variant_path)
+        if future.cancelled():
+            return
+        if future.exception():
+            print(f"Could not render {variant_path}: {future.exception()}", file=sys.stderr)
+            return
+        evict_lru(self.directory, self.budget_bytes, keep=variant_path)
+        if self.on_rendered:
+            self.on_rendered(source_path, speed, variant_path)
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)  # waits for the renders already running, those are quick
+
+
+# Sinks - write(data) takes interleaved s16le bytes of one block
+##########################################################################
+
+
+class NullSink():
+    """Discards the audio. With realtime=True it blocks like a soundcard would, so that the engine keeps the pace."""
+    def __init__(self, sample_rate=ENGINE_SAMPLE_RATE, realtime=True):
+        self.sample_rate = sample_rate
+        self.realtime = realtime
+        self._deadline = None
+
+    def write(self, data):
+        if not self.realtime:
+            return
+        now = monotonic()
+        if self._deadline is None or self._deadline < now:
+            self._deadline = now
+        self._deadline += len(data) / (CHANNELS * 2) / self.sample_rate
+        sleep(max(0, self._deadline - now))
+
+    def close(self):
+        pass
+
+
+class WavSink():
+    """Writes everything that would have been played into a wav file, as fast as possible."""
+    def __init__(self, path, sample_rate=ENGINE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._wav = wave.open(path, "wb")
+        self._wav.setnchannels(CHANNELS)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate)
+
+    def write(self, data):
+        self._wav.writeframes(data)
+
+    def close(self):
+        self._wav.close()
+
+
+class AlsaSink():
+    def __init__(self, sample_rate=ENGINE_SAMPLE_RATE, block_frames=None, device="default"):
+        self.sample_rate = sample_rate
+        self._pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device=device, channels=CHANNELS, rate=sample_rate,
+                                  format=alsaaudio.PCM_FORMAT_S16_LE,
+                                  periodsize=block_frames or sample_rate * ENGINE_BLOCK_MS // 1000)
+
+    def write(self, data):
+        self._pcm.write(data)
+
+    def close(self):
+        self._pcm.close()
+
+
+def make_sink(name=ENGINE_SINK):
+    """"alsa" (falls back to "null" without pyalsaaudio), "null" or "wav:<path>" """
+    if name.startswith("wav:"):
+        return WavSink(name[len("wav:"):])
+    if name == "alsa" and alsaaudio is not None:
+        return AlsaSink()
+    if name == "alsa":
+        print("pyalsaaudio is not installed, playing into the NullSink.")
+    return NullSink()
+
+
+# Engine
+##########################################################################
+
+
+class AudioEngine():
+    """Plays one song after the other into the sink in its own thread. speed, gain and paused can be set from any
+    thread and are picked up at the next block. on_song_end is called (from the engine's thread) whenever a song
+    played through - if a song was preloaded, it is already playing by then."""
+
+    def __init__(self, sink, block_ms=ENGINE_BLOCK_MS, cache=None, variants=None,
+                 variant_tolerance=ENGINE_VARIANT_TOLERANCE):
+        self.sink = sink
+        self.cache = cache
+        self.variants = variants
+        self.variant_tolerance = variant_tolerance
+        if variants:
+            variants.on_rendered = self._variant_rendered
+        self.block_frames = sink.sample_rate * block_ms // 1000
+        self.speed = 1.0
+        self.gain = 1.0
+        self.paused = False
+        self.on_song_end = None
+        self._ramp = np.arange(self.block_frames, dtype=np.float64)
+        self._fade = np.linspace(0, 1, self.block_frames, dtype=np.float32)[:, None]
+        self._silence = bytes(self.block_frames * CHANNELS * 2)
+        self._lock = threading.Lock()
+        self._decoder = None
+        self._next_path = None
+        self._buffer = np.zeros((0, CHANNELS), dtype=np.int16)
+        self._streaming = True  # False if _buffer is the whole song
+        self._pos = 0.0  # fractional read position in _buffer
+        self._variant_decoders = {}
+        self._variants = {}  # speed -> frames of the current song rendered at that speed
+        self._variant_speed = None  # which one was played last
+        self._variant_source = None  # the PCM cache file of the current song, which the variants are rendered from
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.blocks = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            self._set_decoder(None)
+        if self.variants:
+            self.variants.shutdown()
+        self.sink.close()
+
+    def _open(self, path):
+        """(decoder, {speed: variant decoder}) for path - never called with the lock held, as it may start ffmpeg"""
+        decoder = self.cache.open(path) if self.cache else open_decoder(path)
+        if not self.variants or decoder.frames is None:
+            return decoder, {}
+        try:
+            return decoder, self.variants.open(decoder.path, decoder.sample_rate)
+        except BaseException:
+            decoder.close()
+            raise
+
+    @staticmethod
+    def _close(decoder, variant_decoders):
+        if decoder is not None:
+            decoder.close()
+        for variant in variant_decoders.values():
+            variant.close()
+
+    def load(self, path):
+        """replaces the current song (and what was preloaded) right away"""
+        opened = self._open(path)
+        with self._lock:
+            self._set_decoder(*opened)
+            self._next_path = None
+            self.paused = False
+
+    def preload(self, path):
+        with self._lock:
+            self._next_path = path
+        if self.cache:
+            self.cache.prefetch(path)
+
+    def seek_relative(self, secs):
+        """only possible for songs that come from the cache, as only those are completely in memory"""
+        with self._lock:
+            if self._decoder is not None and not self._streaming:
+                self._pos = min(max(0.0, self._pos + secs * self._decoder.sample_rate), len(self._buffer) - 1)
+
+    def _set_decoder(self, decoder, variant_decoders=None):
+        self._buffer = None
+        self._variants = {}
+        self._close(self._decoder, self._variant_decoders)
+        self._decoder = decoder
+        self._streaming = decoder is None or decoder.frames is None
+        self._buffer = np.zeros((0, CHANNELS), dtype=np.int16) if self._streaming else decoder.frames
+        self._pos = 0.0
+        self._variant_decoders = variant_decoders or {}
+        self._variant_speed = None
+        self._variant_source = None
+        if self.variants and not self._streaming:
+            self._variant_source = decoder.path
+            self._variants = {speed: variant.frames for speed, variant in self._variant_decoders.items()}
+            if decoder.sample_rate == self.sink.sample_rate:
+                self._variants[1.0] = decoder.frames
+
+    def _variant_rendered(self, source_path, speed, variant_path):
+        """called by the VariantCache - a variant that is finished while its song plays is used right away"""
+        if source_path != self._variant_source:
+            return
+        try:
+            variant = MmapDecoder(variant_path)
+        except (ValueError, OSError) as e:
+            print(f"Broken variant {variant_path}: {e}", file=sys.stderr)
+            return
+        with self._lock:
+            if source_path == self._variant_source and speed not in self._variant_decoders:
+                self._variant_decoders[speed] = variant
+                self._variants[speed] = variant.frames
+                return
+        variant.close()  # the song changed in the meantime
+
+    def _variant_block(self, speed):
+        """the next block from the pre-rendered variant closest to speed, cross-faded from the previous variant if it
+        changed. _pos stays in source frames, so every variant continues at the same position of the song. None if no
+        variant is within variant_tolerance of speed, or at the end of the song - then the block is resampled."""
+        target = min(self._variants, key=lambda v: abs(v - speed))
+        if abs(target - speed) > self.variant_tolerance:
+            self._variant_speed = None
+            return None
+        frames = self._variants[target]
+        step = target * self._decoder.sample_rate / self.sink.sample_rate
+        start = int(self._pos / step)
+        if start + self.block_frames > len(frames):
+            self._variant_speed = None
+            return None  # the resampling path plays the end of the song
+        block = frames[start:start + self.block_frames].astype(np.float32)
+        previous = self._variants.get(self._variant_speed)
+        if previous is not None and self._variant_speed != target:
+            previous_start = int(self._pos / (self._variant_speed * self._decoder.sample_rate / self.sink.sample_rate))
+            if previous_start + self.block_frames <= len(previous):
+                block = previous[previous_start:previous_start + self.block_frames] * (1 - self._fade) + block * self._fade
+        self._variant_speed = target
+        self._pos += step * self.block_frames
+        return block
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.sink.write(self._next_block())
+            self.blocks += 1
+
+    def _next_block(self):
+        speed = self.speed
+        with self._lock:
+            if self._decoder is None and self._next_path:
+                # the preloaded song could not be opened, or nothing played when it was preloaded: the next one starts
+                block, ended = None, True
+            elif self.paused or speed <= 0 or self._decoder is None:
+                return self._silence
+            else:
+                block, ended = self._variant_block(speed) if self._variants else None, False
+                if block is None:
+                    block, ended = self._resampled_block(speed)
+            if ended:
+                ended_decoder = self._decoder
+                next_path, self._next_path = self._next_path, None
+        if ended:
+            self._next_song(ended_decoder, next_path)
+        return self._silence if block is None else self._output(block)
+
+    def _resampled_block(self, speed):
+        """(the next block interpolated from the source, whether the song ended with it)"""
+        step = speed * self._decoder.sample_rate / self.sink.sample_rate
+        positions = self._pos + step * self._ramp
+        needed = int(positions[-1]) + 2
+        while self._streaming and len(self._buffer) < needed:
+            frames = self._decoder.read_frames(max(needed - len(self._buffer), 4096))
+            if len(frames) == 0:
+                break
+            self._buffer = np.concatenate((self._buffer, frames))
+        if len(self._buffer) < needed:  # end of the song
+            ended = True
+            positions = positions[positions < len(self._buffer) - 1]
+        else:
+            ended = False
+        index = positions.astype(np.intp)
+        frac = (positions - index)[:, None].astype(np.float32)
+        block = np.zeros((self.block_frames, CHANNELS), dtype=np.float32)
+        if len(index):
+            block[:len(index)] = self._buffer[index] * (1 - frac) + self._buffer[index + 1] * frac
+        self._pos += step * self.block_frames
+        if self._streaming:
+            consumed = min(int(self._pos), len(self._buffer))
+            self._buffer = self._buffer[consumed:]
+            self._pos -= consumed
+        return block, ended
+
+    def _next_song(self, ended_decoder, path):
+        """continues with the preloaded song once ended_decoder played through, opened without holding the lock. If it
+        can't be opened (eg. it was deleted since), nothing plays - on_song_end still lets the player move on"""
+        opened = (None, {})
+        if path:
+            try:
+                opened = self._open(path)
+            except OSError as e:
+                print(f"Could not open {path}: {e}", file=sys.stderr)
+        with self._lock:
+            replaced = self._decoder is not ended_decoder  # load() was faster
+            if not replaced:
+                self._set_decoder(*opened)
+        if replaced:
+            self._close(*opened)
+        elif self.on_song_end:
+            self.on_song_end()
+
+    def _output(self, block):
+        if self.gain != 1.0:
+            block *= self.gain
+        return np.clip(block, -32768, 32767).astype("<i2").tobytes()
+
+
+class EnginePlayer(Player):
+    """Player-ABC around the AudioEngine. Understands the mplayer slave commands Leierkasten sends (loadfile, pause,
+    speed_set, quit), but without any pipe or other process."""
+
+    _process = None  # there is no mplayer whose stdout could be read
+
+    def __init__(self, taskman, media_folder, sink=None):
+        self.media_folder = media_folder
+        self.current_tag = None
+        cache = PcmCache() if PCM_CACHE_DIR else None
+        variants = VariantCache(cache) if cache and ENGINE_SPEED_VARIANTS else None
+        self.engine = AudioEngine(sink or make_sink(), cache=cache, variants=variants)
+        self.engine.start()
+
+    def _path(self, filename):
+        return os.path.join(self.media_folder, media_file_filter(filename))
+
+    def play(self, tag, on_done=None):
+        self.current_tag = tag
+        self.engine.on_song_end = on_done
+        self.engine.load(self._path(tag.filename))
+
+    def preload(self, tag, replace=False):
+        self.engine.preload(self._path(tag.filename))
+        return True
+
+    def set_speed(self, speed):
+        self.engine.speed = speed
+
+    def seek_relative(self, secs: int):
+        self.engine.seek_relative(secs)
+
+    def set_gain(self, gain_db: float):
+        self.engine.gain = 10 ** (gain_db / 20)
+
+    def toggle_pause(self):
+        self.engine.paused = not self.engine.paused
+
+    def command(self, *args, poll_outerr=False, ignore_exc=False):
+        cmd = shlex.split(" ".join(str(x) for x in args))
+        if cmd[0] == "loadfile" and len(cmd) > 2 and cmd[2] == "1":
+            self.engine.preload(self._path(cmd[1]))
+        elif cmd[0] == "loadfile":
+            self.engine.load(self._path(cmd[1]))
+        elif cmd[0] == "speed_set":
+            self.set_speed(float(cmd[1]))
+        elif cmd[0] == "seek":
+            self.seek_relative(float(cmd[1]))
+        elif cmd[0] == "pause":
+            self.toggle_pause()
+        elif cmd[0] == "quit":
+            self.shutdown()
+        else:
+            print(f"EnginePlayer: ignoring unknown command {cmd}")
+
+    def shutdown(self):
+        self.engine.stop()
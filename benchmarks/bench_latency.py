@@ -0,0 +1,147 @@
+"""End-to-end latency of the Leierkasten, from the serial port to what arrives at the player.
+
+Runs a real Leierkasten against a pty that stands in for the arduino, with benchmarks/fake_mplayer.py as its mplayer
+(put first on the PATH), which timestamps every command it receives. Both sides use the system-wide monotonic clock,
+so the latencies are measured across the processes:
+
+* rpm_to_speed_set: an "Average RPM" line written to the pty -> the speed_set it causes arrives at mplayer. The lines
+  alternate between two RPMs and come every RPM_INTERVAL seconds, slower than the 0.5 s throttle in
+  handle_serial_events, so that every one of them should cause a speed_set.
+* button_to_loadfile: "button1_released" written -> the loadfile of the next song arrives.
+
+Prints the results as JSON (n, p50/p95/p99/max in ms and how many never arrived), so they can be compared across
+releases. The Leierkasten's own output goes to stderr.
+
+    python benchmarks/bench_latency.py [--samples 50] [--output results.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import tty
+from time import monotonic_ns, sleep, time
+
+RPMS = (30, 20)
+RPM_INTERVAL = 0.6
+BUTTON_INTERVAL = 0.3
+TIMEOUT_NS = 2 * 10 ** 9  # later than that counts as never arrived
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def fake_mplayer_on_path(tmp_dir):
+    bin_dir = os.path.join(tmp_dir, "bin")
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, "mplayer"), "w") as wfile:
+        wfile.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(HERE, "fake_mplayer.py")}" "$@"\n')
+    os.chmod(os.path.join(bin_dir, "mplayer"), 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_MPLAYER_LOG"] = os.path.join(tmp_dir, "commands.log")
+    return os.environ["FAKE_MPLAYER_LOG"]
+
+
+def read_commands(log_path):
+    with open(log_path) as rfile:
+        return [(int(timestamp), command) for timestamp, _, command in (line.rstrip("\n").partition(" ") for line in rfile)]
+
+
+def latencies(sent, commands, matches):
+    """for every (time, expected) in sent, ms until the first command after it for which matches(command, expected)"""
+    result, missed = [], 0
+    for sent_at, expected in sent:
+        arrived = next((t for t, command in commands if t >= sent_at and matches(command, expected)), None)
+        if arrived is None or arrived - sent_at > TIMEOUT_NS:
+            missed += 1
+        else:
+            result.append((arrived - sent_at) / 1e6)
+    return result, missed
+
+
+def summary(values, missed):
+    if len(values) < 2:
+        return {"n": len(values), "missed": missed}
+    percentiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"n": len(values), "missed": missed, "p50_ms": round(percentiles[49], 3), "p95_ms": round(percentiles[94], 3),
+            "p99_ms": round(percentiles[98], 3), "max_ms": round(max(values), 3)}
+
+
+def is_speed_set(command, speed):
+    return command.startswith("speed_set ") and abs(float(command.split()[1]) - speed) < 1e-9
+
+
+def run(samples):
+    tmp_dir = tempfile.mkdtemp(prefix="leierkasten-bench-")
+    log_path = fake_mplayer_on_path(tmp_dir)
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import main  # only now, mplayer_util takes its environment when it is imported
+    from settings import PLAYER
+
+    songs_dir = os.path.join(tmp_dir, "songs")
+    os.makedirs(songs_dir)
+    songs = [f"song{i}.mp3" for i in range(5)]
+    for song in songs:
+        open(os.path.join(songs_dir, song), "wb").close()
+    master, slave = os.openpty()
+    tty.setraw(slave)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        kasten = main.Leierkasten(songs_dir, songs, serial_port=os.ttyname(slave))
+        kasten.play()
+        thread = threading.Thread(target=kasten.run)
+        thread.start()
+        sleep(1)  # mplayer starting up
+
+        speed_sets = []
+        for i in range(samples):
+            rpm = RPMS[i % len(RPMS)]
+            sent_at = monotonic_ns()
+            os.write(master, f"Average RPM (Last 500 ms): {rpm:.2f}\r\n".encode())
+            speed_sets.append((sent_at, kasten.speed_curve(rpm)))
+            sleep(RPM_INTERVAL)
+        # every button toggles the pause as well, so they come after all RPM samples
+        loadfiles = []
+        for i in range(samples):
+            sent_at = monotonic_ns()
+            os.write(master, b"button1_released\r\n")
+            loadfiles.append((sent_at, None))
+            sleep(BUTTON_INTERVAL)
+
+        sleep(TIMEOUT_NS / 1e9)
+        kasten.kill()
+        thread.join(10)
+    os.close(master)
+    os.close(slave)
+
+    commands = read_commands(log_path)
+    shutil.rmtree(tmp_dir)
+    rpm_latencies = latencies(speed_sets, commands, is_speed_set)
+    button_latencies = latencies(loadfiles, commands, lambda command, _: command.startswith("loadfile "))
+    return {
+        "benchmark": "crank_to_player_latency",
+        "time": round(time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "player": PLAYER,
+        "rpm_to_speed_set": summary(*rpm_latencies),
+        "button_to_loadfile": summary(*button_latencies),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=50, help="of each kind")
+    parser.add_argument("--output", help="write the JSON there instead of to stdout")
+    args = parser.parse_args()
+    results = json.dumps(run(args.samples), indent=2)
+    if args.output:
+        with open(args.output, "w") as wfile:
+            wfile.write(results + "\n")
+    else:
+        print(results)
@@ -0,0 +1,108 @@
+"""queue.Queue vs. event_util.Latest for handing the newest RPM to the playback_thread, with several threads publishing
+at the same time.
+
+WRITERS threads publish as fast as they can while a reader wakes up every READ_INTERVAL and takes what it would use:
+the next item of a Queue (what the playback_thread did once, a FIFO of stale readings), the newest item after draining
+the Queue, or Latest.read(). Reported are the cost of one publish and one read under that contention, and how old the
+value was that the reader ended up with.
+
+    python benchmarks/bench_latest_value.py
+"""
+
+import os
+import sys
+import threading
+from queue import Queue, Empty
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from event_util import Latest
+
+WRITERS = 4
+PER_WRITER = 50000
+READ_INTERVAL = 0.001
+
+
+class QueueNext():
+    def __init__(self):
+        self.queue = Queue()
+
+    def publish(self, value):
+        self.queue.put((value, monotonic()))
+
+    def read(self):
+        try:
+            return self.queue.get_nowait()
+        except Empty:
+            return None
+
+
+class QueueDrain(QueueNext):
+    def read(self):
+        newest = None
+        while True:
+            try:
+                newest = self.queue.get_nowait()
+            except Empty:
+                return newest
+
+
+class LatestValue():
+    def __init__(self):
+        self.latest = Latest()
+
+    def publish(self, value):
+        self.latest.publish(value)
+
+    def read(self):
+        sample = self.latest.read()
+        return (sample.value, sample.timestamp) if sample.seq else None
+
+
+def run(channel):
+    publish_seconds = []
+    read_seconds, ages = [], []
+    done = threading.Event()
+
+    def writer():
+        start = perf_counter()
+        for i in range(PER_WRITER):
+            channel.publish(i)
+        publish_seconds.append(perf_counter() - start)
+
+    def reader():
+        while not done.is_set():
+            sleep(READ_INTERVAL)
+            start = perf_counter()
+            got = channel.read()
+            read_seconds.append(perf_counter() - start)
+            if got is not None:
+                ages.append(monotonic() - got[1])
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    writers = [threading.Thread(target=writer) for _ in range(WRITERS)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    reader_thread.join()
+    per_publish = sum(publish_seconds) / (WRITERS * PER_WRITER) * 1e9
+    ages = np.array(ages) * 1000
+    return per_publish, np.mean(read_seconds) * 1e9, np.median(ages), np.percentile(ages, 99)
+
+
+def main():
+    print(f"{WRITERS} writers x {PER_WRITER} values, a read every {READ_INTERVAL * 1000:.0f} ms")
+    print(f"{'':<24}{'publish':>12}{'read':>16}{'age p50':>12}{'age p99':>12}")
+    for name, channel in (("Queue, next item", QueueNext()), ("Queue, drained", QueueDrain()),
+                          ("Latest", LatestValue())):
+        per_publish, per_read, age_p50, age_p99 = run(channel)
+        print(f"{name:<24}{per_publish:>9.0f} ns{per_read:>13.0f} ns{age_p50:>9.2f} ms{age_p99:>9.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
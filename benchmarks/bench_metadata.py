@@ -0,0 +1,52 @@
+"""Cold metadata extraction of a library with 1, 2, ... os.cpu_count() worker processes.
+
+    python benchmarks/bench_metadata.py [music-folder]
+
+Without a folder, a temporary one with synthetic mp3 files (ID3 tag + CBR frames) is used.
+"""
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from library_util import LibraryIndex
+
+N_SYNTHETIC = 2000
+
+
+def make_library(directory):
+    title = b"\x03Some Title"
+    frame = b"TIT2" + len(title).to_bytes(4, "big") + b"\0\0" + title
+    tag = b"ID3\x03\x00\x00" + bytes([0, 0, 0, len(frame)]) + frame
+    mp3_frame = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)  # MPEG1 layer III, 128 kbit/s, 44.1 kHz
+    for i in range(N_SYNTHETIC):
+        with open(os.path.join(directory, f"{i:05d}.mp3"), "wb") as wfile:
+            wfile.write(tag + mp3_frame * 500)
+
+
+def bench(directory):
+    index = LibraryIndex(directory, os.path.join(tempfile.gettempdir(), "bench_metadata.json"))
+    index.scan()
+    n_files = len(index.songs())
+    cores = os.cpu_count() or 1
+    single = None
+    for workers in sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i < cores} | {cores}):
+        for entry in index.dirs.values():
+            for info in entry["files"].values():
+                info.pop("meta", None)
+        start = perf_counter()
+        index.update_metadata(workers=workers)
+        took = perf_counter() - start
+        single = single or took
+        print(f"{workers:>2} workers: {took:6.2f}s  {n_files / took:8.0f} files/s  speedup {single / took:4.2f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        bench(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            make_library(directory)
+            bench(directory)
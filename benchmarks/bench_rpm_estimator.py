@@ -0,0 +1,113 @@
+"""Step response of the RPM as the Leierkasten sees it: the firmware's moving average (every DIP-switch window, plus the
+0.5 s throttle in handle_serial_events) vs. rpm_util.RpmEstimator on raw counts, with every filter.
+
+A simulated crank turns at 20 RPM with a slightly uneven hand, and at STEP_AT jumps to 40 RPM. The encoder is sampled
+like the firmware does (24 steps per revolution, a loop every ~10 ms). Reported are the lag until the RPM reaches 90%
+of the step, the overshoot, the jitter while cranking steadily, and what one estimator update costs.
+
+    python benchmarks/bench_rpm_estimator.py
+"""
+
+import math
+import os
+import random
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from rpm_util import RpmEstimator, FILTERS
+
+STEPS_PER_REVOLUTION = 24
+LOOP_MS = 11  # delay(10) plus the rest of loop()
+UPDATE_INTERVAL = 100
+HEARTBEAT_MS = 100
+WINDOWS = [500, 1000, 1500, 2000, 3000, 5000, 7000, 10000]
+RPM_BEFORE, RPM_AFTER = 20, 40
+STEP_AT = 15.0
+DURATION = 30.0
+
+
+def crank(seed=42):
+    """encoder count at every loop of the firmware, as (millis, count) arrays"""
+    rnd = random.Random(seed)
+    times = np.arange(0, int(DURATION * 1000), LOOP_MS)
+    position = 0.0
+    counts = []
+    for millis in times:
+        t = millis / 1000
+        rpm = RPM_BEFORE if t < STEP_AT else RPM_AFTER
+        rpm *= 1 + 0.08 * math.sin(2 * math.pi * t * rpm / 60) + rnd.gauss(0, 0.02)  # uneven within a revolution
+        position += rpm / 60 * STEPS_PER_REVOLUTION * LOOP_MS / 1000
+        counts.append(int(position))
+    return times, np.array(counts)
+
+
+def firmware_average(times, counts, window_ms):
+    """what arrives at the playback thread: the firmware's mean every 100 ms, of which only one per 0.5 s is taken"""
+    buffer_size = window_ms // UPDATE_INTERVAL
+    buffer = [0] * buffer_size
+    index = 0
+    last_update = last_taken = -10 ** 9
+    out_times, out_rpm = [], []
+    for millis, count in zip(times, counts):
+        if millis - last_update >= UPDATE_INTERVAL:
+            index = (index + 1) % buffer_size
+            buffer[index] = count
+            oldest = buffer[(index + 1) % buffer_size]
+            rpm = (count - oldest) * 60.0 * 1000 / (STEPS_PER_REVOLUTION * UPDATE_INTERVAL) / (buffer_size - 1)
+            last_update = millis
+            if millis - last_taken >= 500:
+                out_times.append(millis)
+                out_rpm.append(rpm)
+                last_taken = millis
+    return np.array(out_times), np.array(out_rpm)
+
+
+def raw_frames(times, counts):
+    """the FRAME_COUNTS the firmware sends with RAW_COUNTS, as (millis, steps)"""
+    frames = []
+    last_count, last_sent = 0, -10 ** 9
+    for millis, count in zip(times, counts):
+        if count != last_count or millis - last_sent >= HEARTBEAT_MS:
+            frames.append((int(millis), int(count - last_count)))
+            last_count, last_sent = count, millis
+    return frames
+
+
+def estimated(frames, filter):
+    estimator = RpmEstimator(filter)
+    out = np.array([estimator.update(millis, steps) for millis, steps in frames])
+    return np.array([i[0] for i in frames]), out
+
+
+def step_response(times, rpm):
+    """(ms until 90% of the step, overshoot in RPM, standard deviation in RPM while cranking steadily)"""
+    steady = rpm[(times > (STEP_AT - 5) * 1000) & (times < STEP_AT * 1000)]
+    after = (times >= STEP_AT * 1000)
+    reached = np.nonzero(after & (rpm >= RPM_BEFORE + 0.9 * (RPM_AFTER - RPM_BEFORE)))[0]
+    lag = times[reached[0]] - STEP_AT * 1000 if len(reached) else float("nan")
+    return lag, max(0.0, rpm[after].max() - RPM_AFTER), steady.std()
+
+
+def main():
+    times, counts = crank()
+    print(f"Step from {RPM_BEFORE} to {RPM_AFTER} RPM:")
+    print(f"{'':<28}{'lag to 90%':>12}{'overshoot':>12}{'jitter':>10}{'per update':>12}")
+    for window in WINDOWS:
+        lag, overshoot, jitter = step_response(*firmware_average(times, counts, window))
+        print(f"{f'firmware mean {window} ms':<28}{lag:>9.0f} ms{overshoot:>8.1f} RPM{jitter:>6.2f} RPM")
+    frames = raw_frames(times, counts)
+    for name in FILTERS:
+        lag, overshoot, jitter = step_response(*estimated(frames, name))
+        estimator = RpmEstimator(name)
+        start = perf_counter()
+        for millis, steps in frames:
+            estimator.update(millis, steps)
+        per_update = (perf_counter() - start) / len(frames) * 1e6
+        print(f"{f'estimator {name}':<28}{lag:>9.0f} ms{overshoot:>8.1f} RPM{jitter:>6.2f} RPM{per_update:>9.1f} µs")
+
+
+if __name__ == '__main__':
+    main()
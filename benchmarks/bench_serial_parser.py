@@ -0,0 +1,49 @@
+"""How many RPM messages per second SerialParser decodes, for binary frames vs. text lines, clean and with corruption.
+
+    python benchmarks/bench_serial_parser.py
+"""
+
+import os
+import random
+import struct
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from serial_util import SerialParser, build_frame, FRAME_RPM, RPM
+
+N_MESSAGES = 100000
+CHUNK_SIZE = 64  # roughly what is in_waiting at 115200 baud when the reader wakes up
+
+
+def make_stream(binary, corrupt_every=0):
+    rnd = random.Random(42)
+    stream = bytearray()
+    for i in range(N_MESSAGES):
+        rpm = rnd.uniform(-60, 60)
+        if binary:
+            msg = bytearray(build_frame(FRAME_RPM, struct.pack("<fH", rpm, 1000)))
+        else:
+            msg = bytearray(f"Average RPM (Last 1000 ms): {rpm:.2f}\r\n".encode())
+        if corrupt_every and i % corrupt_every == 0:
+            msg[rnd.randrange(len(msg))] ^= 0xFF
+        stream += msg
+    return bytes(stream)
+
+
+def bench(name, stream):
+    parser = SerialParser()
+    decoded = 0
+    start = perf_counter()
+    for pos in range(0, len(stream), CHUNK_SIZE):
+        for event in parser.feed(stream[pos:pos + CHUNK_SIZE]):
+            decoded += event[0] == RPM
+    took = perf_counter() - start
+    print(f"{name:<22} {decoded / took:>10.0f} msgs/s   {decoded:>6} decoded, {parser.errors} resyncs")
+
+
+if __name__ == '__main__':
+    bench("binary", make_stream(True))
+    bench("binary, 1% corrupted", make_stream(True, corrupt_every=100))
+    bench("text", make_stream(False))
+    bench("text, 1% corrupted", make_stream(False, corrupt_every=100))
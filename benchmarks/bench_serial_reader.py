@@ -0,0 +1,70 @@
+"""Per-line readline() (what read_rpm_thread used to do) vs. SerialReader, reading a burst of RPM lines through a pty.
+
+    python benchmarks/bench_serial_reader.py
+"""
+
+import os
+import pty
+import selectors
+import sys
+import threading
+import tty
+from time import perf_counter
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from serial_util import SerialReader, RPM
+
+N_LINES = 20000
+LINE = b"Average RPM (Last 1000 ms): 23.45\r\n"
+
+
+def writer(master):
+    data = LINE * N_LINES
+    view = memoryview(data)
+    while view:
+        view = view[os.write(master, view[:4096]):]
+
+
+def run(name, consume):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), 115200)
+    thread = threading.Thread(target=writer, args=(master,))
+    start = perf_counter()
+    thread.start()
+    reads = consume(ser)
+    took = perf_counter() - start
+    thread.join()
+    print(f"{name:<12} {N_LINES / took:>9.0f} lines/s   {reads:>6} read calls")
+    ser.close()
+    os.close(master)
+    os.close(slave)
+
+
+def consume_readline(ser):
+    lines = 0
+    reads = 0
+    while lines < N_LINES:
+        line = ser.readline()
+        reads += len(line)  # pyserial's readline reads byte by byte
+        if line.startswith(b"Average RPM"):
+            lines += 1
+    return reads
+
+
+def consume_reader(ser):
+    reader = SerialReader(ser)
+    selector = selectors.DefaultSelector()
+    selector.register(reader, selectors.EVENT_READ)
+    lines = 0
+    while lines < N_LINES:
+        selector.select()
+        lines += sum(event[0] == RPM for event in reader.read_events())
+    return reader.reads
+
+
+if __name__ == '__main__':
+    run("readline", consume_readline)
+    run("SerialReader", consume_reader)
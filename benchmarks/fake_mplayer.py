@@ -0,0 +1,34 @@
+"""Stands in for `mplayer -slave -idle` in bench_latency.py: appends every command it gets on stdin, with the
+time.monotonic_ns() it arrived at, to $FAKE_MPLAYER_LOG, and answers loadfile and the get_* queries like mplayer does,
+without playing anything (so no song ever ends by itself)."""
+
+import os
+import sys
+import time
+
+LENGTH = 180.0
+
+loaded_at, speed = None, 1.0
+with open(os.environ["FAKE_MPLAYER_LOG"], "a", buffering=1) as log:
+    for line in sys.stdin.buffer:
+        now = time.monotonic_ns()
+        command = line.decode("utf8", errors="replace").strip()
+        log.write(f"{now} {command}\n")
+        command = command.removeprefix("pausing_keep_force ")
+        if command.startswith("loadfile"):
+            loaded_at = now
+            print(f"Playing {command.split(' ', 1)[1]}.", flush=True)
+        elif command.startswith("speed_set"):
+            speed = float(command.split()[1])
+        elif loaded_at is None:
+            pass  # like mplayer, nothing to answer while nothing plays
+        elif command == "get_time_pos":
+            print(f"ANS_TIME_POSITION={(now - loaded_at) / 1e9:.1f}", flush=True)
+        elif command == "get_time_length":
+            print(f"ANS_LENGTH={LENGTH:.2f}", flush=True)
+        elif command == "get_property speed":
+            print(f"ANS_speed={speed:.2f}", flush=True)
+        elif command.startswith("get_property"):
+            print("ANS_ERROR=PROPERTY_UNKNOWN", flush=True)
+        elif command == "quit":
+            break
@@ -0,0 +1,111 @@
+"""Small building blocks for the threads of the Leierkasten to wait for each other without polling."""
+
+import os
+import selectors
+import threading
+from collections import deque
+from time import monotonic
+from typing import Any, NamedTuple
+
+
+class Waker(object):
+    """self-pipe, so that a thread blocking in select() can be woken up by another thread"""
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+    def fileno(self):
+        return self._read_fd
+    def wake(self):
+        try:
+            os.write(self._write_fd, b"x")
+        except BlockingIOError:
+            pass  # pipe is full, so the reader will wake up anyway
+    def drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class Sample(NamedTuple):
+    value: Any
+    seq: int  # 0 for the initial value, +1 for every publish()
+    timestamp: float  # time.monotonic() of the publish()
+
+
+class Latest(object):
+    """conflating channel that only keeps the newest value: publish() overwrites it, read() returns it as a Sample
+    without waiting for anything. A reader that remembers the seq of what it read last knows whether something new came,
+    and how many values it missed in between. Publishers take a lock among themselves so that the seqs stay in order,
+    readers never do - the Sample is replaced as a whole, which is atomic."""
+    def __init__(self, value=None, on_publish=None):
+        self._sample = Sample(value, 0, monotonic())
+        self._publish_lock = threading.Lock()
+        self.on_publish = on_publish  # eg. to wake up the reader
+    def publish(self, value):
+        with self._publish_lock:
+            self._sample = Sample(value, self._sample.seq + 1, monotonic())
+        if self.on_publish:
+            self.on_publish()
+    def read(self):
+        return self._sample
+    @property
+    def value(self):
+        return self._sample.value
+
+
+class ProcessSupervisor(object):
+    """tells the moment a child process exits through a selector, without polling: with os.pidfd_open (Linux 5.3+)
+    every watched process gets an fd that becomes readable when it exits. Without it, a thread waits for the process in
+    waitpid and then wakes up the selector through a Waker. Whoever runs the selector passes the keys whose data is the
+    supervisor to handle(), which reaps the process and calls on_exit(process, returncode)."""
+    def __init__(self, selector, on_exit):
+        self.selector = selector
+        self.on_exit = on_exit
+        self._pidfds = {}  # fd -> process
+        self._exited = deque()  # reaped by the waitpid threads
+        self._waker = None
+    def watch(self, process):
+        """process is a subprocess.Popen"""
+        if process.returncode is None:
+            try:
+                fd = os.pidfd_open(process.pid)
+            except (AttributeError, OSError):  # an older kernel or python, or it already exited
+                pass
+            else:
+                self._pidfds[fd] = process
+                self.selector.register(fd, selectors.EVENT_READ, self)
+                return
+        if self._waker is None:
+            self._waker = Waker()
+            self.selector.register(self._waker, selectors.EVENT_READ, self)
+        def wait():
+            process.wait()
+            self._exited.append(process)
+            self._waker.wake()
+        threading.Thread(target=wait, name=f"waitpid {process.pid}", daemon=True).start()
+    def handle(self, key):
+        if key.fileobj is self._waker:
+            self._waker.drain()
+            while self._exited:
+                process = self._exited.popleft()
+                self.on_exit(process, process.returncode)
+            return
+        process = self._pidfds.pop(key.fd)
+        self.selector.unregister(key.fd)
+        os.close(key.fd)
+        self.on_exit(process, process.wait())  # it exited already, this only reaps it
+    def close(self):
+        for fd in self._pidfds:
+            self.selector.unregister(fd)
+            os.close(fd)
+        self._pidfds.clear()
+        if self._waker is not None:
+            self.selector.unregister(self._waker)
+            self._waker.close()
+            self._waker = None
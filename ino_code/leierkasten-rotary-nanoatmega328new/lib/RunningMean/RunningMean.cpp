@@ -0,0 +1,27 @@
+#include "RunningMean.h"
+
+RunningMean::RunningMean(int size) {
+  reset(size);
+}
+
+void RunningMean::reset(int size) {
+  size_ = size < 1 ? 1 : (size > MAX_SIZE ? MAX_SIZE : size);
+  sum_ = 0;
+  index_ = 0;
+  count_ = 0;
+}
+
+void RunningMean::add(int16_t value) {
+  if (count_ == size_) {
+    sum_ -= values_[index_];
+  } else {
+    ++count_;
+  }
+  values_[index_] = value;
+  sum_ += value;
+  index_ = index_ + 1 == size_ ? 0 : index_ + 1;
+}
+
+float RunningMean::mean() const {
+  return count_ ? (float)sum_ / count_ : 0;
+}
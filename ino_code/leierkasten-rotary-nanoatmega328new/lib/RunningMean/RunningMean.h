@@ -0,0 +1,28 @@
+#ifndef RUNNING_MEAN_H
+#define RUNNING_MEAN_H
+
+#include <stdint.h>
+
+// Mean of the last `size` values in O(1) per value: a ring buffer plus a running sum, where the value that drops out
+// of the window is subtracted again. Until the window is full, the mean is over the values added so far, so neither
+// the start nor a window change (reset()) drags the mean towards 0.
+class RunningMean {
+ public:
+  static const int MAX_SIZE = 100;
+
+  explicit RunningMean(int size = MAX_SIZE);
+  void reset(int size);  // forgets everything, size is clamped to 1..MAX_SIZE
+  void add(int16_t value);
+  float mean() const;
+  int size() const { return size_; }
+  int count() const { return count_; }
+
+ private:
+  int16_t values_[MAX_SIZE];
+  int32_t sum_;
+  int size_;
+  int index_;  // where the next value goes
+  int count_;
+};
+
+#endif
@@ -1,6 +1,7 @@
 #include <Arduino.h>
 #include <BasicEncoder.h>
 #include <TimerOne.h>
+#include <RunningMean.h>
 
 BasicEncoder encoder(10, 11);
 
@@ -11,6 +12,18 @@ const int BUTTON_PIN = 3;
 
 
 const int PRINT_ALL_MS = 100;
+// true: send RPM and button events as compact binary frames instead of text lines (see serial_util.py on the pi).
+// The DIP-switch dumps stay text, the pi understands both.
+const bool BINARY_PROTOCOL = false;
+const byte FRAME_SYNC = 0xA5;
+const byte FRAME_RPM = 0x01;     // float32 rpm, uint16 mean-interval in ms
+const byte FRAME_BUTTON = 0x02;  // uint8, 1 = pressed, 0 = released
+const byte FRAME_WINDOW = 0x03;  // uint16 mean-interval in ms
+const byte FRAME_COUNTS = 0x04;  // uint32 millis, int16 encoder steps since the last FRAME_COUNTS
+// true: additionally send the raw encoder counts whenever the encoder moved (at least every COUNTS_HEARTBEAT_MS), the
+// pi then estimates the RPM itself with much less lag than the mean below (see rpm_util.py)
+const bool RAW_COUNTS = false;
+const unsigned long COUNTS_HEARTBEAT_MS = 100;
 const float INTERVAL_OPTIONS[] = {500, 1000, 1500, 2000, 3000, 5000, 7000, 10000};
 const unsigned long UPDATE_INTERVAL = 100;   // 200 milliseconds update interval
 const int STEPS_PER_REVOLUTION = 24; // 24 steps per revolution
@@ -19,13 +32,15 @@ const int MAX_BUFFERSIZE = 10000 / UPDATE_INTERVAL;
 
 
 // unsigned long MEAN_TIME_INTERVAL = MAX_MEANTIMEINTERVAL; 
-int encoderBuffer[MAX_BUFFERSIZE];
-int bufferIndex = 0;
 int MEAN_TIME_INTERVAL = MAX_MEANTIMEINTERVAL;
 int BUFFER_SIZE = MAX_BUFFERSIZE;
+RunningMean encoderChanges(BUFFER_SIZE);  // encoder steps per UPDATE_INTERVAL, over the last MEAN_TIME_INTERVAL
+int lastBufferedCount = 0;
 
 unsigned long lastUpdateTime = 0;
 unsigned long lastPrintTime = 0;
+unsigned long lastCountsTime = 0;
+int lastSentCount = 0;
 bool initialized = false;
 
 
@@ -42,6 +57,37 @@ void timer_service() {
   encoder.service();
 }
 
+// SYNC | type | length | payload | checksum, with checksum = (type + length + payload bytes) % 256
+void send_frame(byte type, const byte* payload, byte length) {
+  byte checksum = type + length;
+  Serial.write(FRAME_SYNC);
+  Serial.write(type);
+  Serial.write(length);
+  for (byte i = 0; i < length; ++i) {
+    Serial.write(payload[i]);
+    checksum += payload[i];
+  }
+  Serial.write(checksum);
+}
+
+void send_rpm_frame(float rpm, uint16_t interval) {
+  byte payload[6];
+  memcpy(payload, &rpm, 4);  // AVR floats are little endian IEEE-754, just like the pi's
+  memcpy(payload + 4, &interval, 2);
+  send_frame(FRAME_RPM, payload, sizeof(payload));
+}
+
+void send_window_frame(uint16_t interval) {
+  send_frame(FRAME_WINDOW, (const byte*)&interval, 2);
+}
+
+void send_counts_frame(uint32_t time, int16_t steps) {
+  byte payload[6];
+  memcpy(payload, &time, 4);
+  memcpy(payload + 4, &steps, 2);
+  send_frame(FRAME_COUNTS, payload, sizeof(payload));
+}
+
 
 
 void buffer_from_dips() {
@@ -57,6 +103,10 @@ void buffer_from_dips() {
     MEAN_TIME_INTERVAL = new_mean_timeinterval;
     BUFFER_SIZE = MEAN_TIME_INTERVAL / UPDATE_INTERVAL;
     Serial.print("BUFFER_SIZE "); Serial.println(BUFFER_SIZE);
+    encoderChanges.reset(BUFFER_SIZE);
+    if (BINARY_PROTOCOL) {
+      send_window_frame(MEAN_TIME_INTERVAL);
+    }
   }      
 }
 
@@ -105,11 +155,6 @@ void setup() {
   
   readPins();
 
-  // Initialize encoder buffer with zeros
-  for (int i = 0; i < BUFFER_SIZE; ++i) {
-    encoderBuffer[i] = 0;
-  }
-
   Serial.println("Started");
 }
 
@@ -126,7 +171,10 @@ void service_buttons() {
     initialized = true;
   }
   if (button_state != last_button_state) {
-    if (button_state == LOW) {
+    if (BINARY_PROTOCOL) {
+      byte pressed = (button_state == LOW) ? 1 : 0;
+      send_frame(FRAME_BUTTON, &pressed, 1);
+    } else if (button_state == LOW) {
       Serial.write("button1_pressed\n");
     } else {
       Serial.write("button1_released\n");
@@ -179,29 +227,28 @@ void loop() {
   unsigned long currentTime = millis();
   int encoderValue = encoder.get_count();
 
+  if (RAW_COUNTS && (encoderValue != lastSentCount || currentTime - lastCountsTime >= COUNTS_HEARTBEAT_MS)) {
+    send_counts_frame(currentTime, encoderValue - lastSentCount);
+    lastSentCount = encoderValue;
+    lastCountsTime = currentTime;
+  }
+
   if (currentTime - lastUpdateTime >= UPDATE_INTERVAL) {
-    // Shift buffer and store the new encoder value
-    bufferIndex = (bufferIndex + 1) % BUFFER_SIZE;
-    encoderBuffer[bufferIndex] = encoderValue;
-
-    // Calculate mean RPM based on buffer values
-    float sumRpm = 0;
-    int startIndex = (bufferIndex + 1) % BUFFER_SIZE; // Start index for calculating mean RPM
-
-    
-    for (int i = 0; i < BUFFER_SIZE - 1; ++i) {
-      int encoderChange = encoderBuffer[startIndex] - encoderBuffer[(startIndex + 1) % BUFFER_SIZE];
-      float rpm = (encoderChange * 60.0 * 1000) / (STEPS_PER_REVOLUTION * UPDATE_INTERVAL);
-      sumRpm += rpm;
-      startIndex = (startIndex + 1) % BUFFER_SIZE;
-    }
+    // Older minus newer count, so turning forward is negative like it always was (the pi takes abs()). As a
+    // difference it stays right when the encoder count overflows.
+    encoderChanges.add((int16_t)(lastBufferedCount - encoderValue));
+    lastBufferedCount = encoderValue;
 
     // Calculate the mean RPM
-    float meanRpm = sumRpm / (BUFFER_SIZE - 1);
+    float meanRpm = encoderChanges.mean() * 60.0 * 1000 / (STEPS_PER_REVOLUTION * UPDATE_INTERVAL);
 
     if (currentTime - lastPrintTime >= PRINT_ALL_MS) {
-      Serial.print("Average RPM (Last "); Serial.print(MEAN_TIME_INTERVAL); Serial.print(" ms): ");
-      Serial.println(meanRpm, 2); // Print average RPM with 2 decimal places
+      if (BINARY_PROTOCOL) {
+        send_rpm_frame(meanRpm, MEAN_TIME_INTERVAL);
+      } else {
+        Serial.print("Average RPM (Last "); Serial.print(MEAN_TIME_INTERVAL); Serial.print(" ms): ");
+        Serial.println(meanRpm, 2); // Print average RPM with 2 decimal places
+      }
       lastPrintTime = currentTime;
     }
 
@@ -0,0 +1,98 @@
+#include <unity.h>
+#include <stdlib.h>
+
+#include <RunningMean.h>
+
+void setUp() {}
+void tearDown() {}
+
+// the mean over the last `size` changes of the encoder counts, summed up from scratch every time. Unlike the loop
+// main.cpp had before, which always divided by BUFFER_SIZE - 1 even while the buffer was still filling up
+float window_mean(const int* counts, int n, int size) {
+  int first = n - size < 0 ? 0 : n - size;
+  float sum = 0;
+  for (int i = first; i < n; ++i) {
+    sum += counts[i] - (i ? counts[i - 1] : 0);
+  }
+  return sum / (n - first);
+}
+
+void test_constant() {
+  RunningMean mean(5);
+  for (int i = 0; i < 20; ++i) {
+    mean.add(3);
+  }
+  TEST_ASSERT_EQUAL_FLOAT(3, mean.mean());
+}
+
+void test_partial_window_is_not_diluted() {
+  RunningMean mean(10);
+  TEST_ASSERT_EQUAL_FLOAT(0, mean.mean());
+  mean.add(4);
+  mean.add(2);
+  TEST_ASSERT_EQUAL_INT(2, mean.count());
+  TEST_ASSERT_EQUAL_FLOAT(3, mean.mean());
+}
+
+void test_old_values_drop_out() {
+  RunningMean mean(3);
+  mean.add(100);
+  mean.add(1);
+  mean.add(2);
+  mean.add(3);
+  TEST_ASSERT_EQUAL_INT(3, mean.count());
+  TEST_ASSERT_EQUAL_FLOAT(2, mean.mean());
+}
+
+void test_reset_on_window_change() {
+  RunningMean mean(10);
+  for (int i = 0; i < 10; ++i) {
+    mean.add(8);
+  }
+  mean.reset(5);
+  TEST_ASSERT_EQUAL_INT(0, mean.count());
+  mean.add(2);
+  TEST_ASSERT_EQUAL_FLOAT(2, mean.mean());
+  for (int i = 0; i < 7; ++i) {
+    mean.add(-1);
+  }
+  TEST_ASSERT_EQUAL_INT(5, mean.count());
+  TEST_ASSERT_EQUAL_FLOAT(-1, mean.mean());
+}
+
+void test_size_is_clamped() {
+  RunningMean mean(0);
+  TEST_ASSERT_EQUAL_INT(1, mean.size());
+  mean.reset(1000);
+  TEST_ASSERT_EQUAL_INT(RunningMean::MAX_SIZE, mean.size());
+}
+
+void test_same_as_summing_the_window() {
+  const int n = 2000;
+  static int counts[n];
+  srand(42);
+  int count = 0;
+  for (int i = 0; i < n; ++i) {
+    count += rand() % 9 - 2;
+    counts[i] = count;
+  }
+  const int sizes[] = {5, 10, 15, 20, 30, 50, 70, 100};
+  for (int size : sizes) {
+    RunningMean mean(size);
+    for (int i = 0; i < n; ++i) {
+      mean.add(counts[i] - (i ? counts[i - 1] : 0));
+      TEST_ASSERT_FLOAT_WITHIN(1e-3, window_mean(counts, i + 1, size), mean.mean());
+    }
+  }
+}
+
+int main() {
+  UNITY_BEGIN();
+  RUN_TEST(test_constant);
+  RUN_TEST(test_partial_window_is_not_diluted);
+  RUN_TEST(test_old_values_drop_out);
+  RUN_TEST(test_reset_on_window_change);
+  RUN_TEST(test_size_is_clamped);
+  RUN_TEST(test_same_as_summing_the_window);
+  return UNITY_END();
+}
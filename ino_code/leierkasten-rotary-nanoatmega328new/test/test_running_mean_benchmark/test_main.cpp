@@ -0,0 +1,62 @@
+// Time per 100 ms update of the old O(n) loop over the 10 s window vs. RunningMean. On the ATmega the ratio is about
+// the same, but the absolute numbers are a lot higher (no FPU - the old loop did a float division per entry).
+#include <unity.h>
+#include <chrono>
+#include <stdio.h>
+
+#include <RunningMean.h>
+
+void setUp() {}
+void tearDown() {}
+
+const int UPDATES = 1000000;
+const int BUFFER_SIZE = 100;
+volatile float sink;
+
+double nanoseconds_per_update(void (*run)()) {
+  auto start = std::chrono::steady_clock::now();
+  run();
+  return std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count() / UPDATES;
+}
+
+void old_loop() {
+  int encoderBuffer[BUFFER_SIZE] = {0};
+  int bufferIndex = 0;
+  for (int update = 0; update < UPDATES; ++update) {
+    bufferIndex = (bufferIndex + 1) % BUFFER_SIZE;
+    encoderBuffer[bufferIndex] = update * 3;
+    float sumRpm = 0;
+    int startIndex = (bufferIndex + 1) % BUFFER_SIZE;
+    for (int i = 0; i < BUFFER_SIZE - 1; ++i) {
+      int encoderChange = encoderBuffer[startIndex] - encoderBuffer[(startIndex + 1) % BUFFER_SIZE];
+      sumRpm += (encoderChange * 60.0 * 1000) / (24 * 100);
+      startIndex = (startIndex + 1) % BUFFER_SIZE;
+    }
+    sink = sumRpm / (BUFFER_SIZE - 1);
+  }
+}
+
+void running_mean() {
+  RunningMean mean(BUFFER_SIZE);
+  int last = 0;
+  for (int update = 0; update < UPDATES; ++update) {
+    mean.add(last - update * 3);
+    last = update * 3;
+    sink = mean.mean() * 60.0 * 1000 / (24 * 100);
+  }
+}
+
+void test_benchmark() {
+  double before = nanoseconds_per_update(old_loop);
+  double after = nanoseconds_per_update(running_mean);
+  char message[100];
+  snprintf(message, sizeof(message), "old loop %.1f ns, RunningMean %.1f ns per update", before, after);
+  TEST_MESSAGE(message);
+  TEST_ASSERT_TRUE(after < before);
+}
+
+int main() {
+  UNITY_BEGIN();
+  RUN_TEST(test_benchmark);
+  return UNITY_END();
+}
@@ -0,0 +1,496 @@
+"""The song library under BASE_DIR, indexed into SONGS_JSON so that a restart does not have to look at every file.
+
+The index remembers every directory's mtime - as adding, removing or renaming an entry changes the mtime of the
+directory it is in, only directories whose mtime changed have to be listed again, for all others one stat() suffices.
+"""
+
+import ctypes
+import ctypes.util
+import itertools
+import json
+import os
+import selectors
+import struct
+import subprocess
+import sys
+import threading
+import wave
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+
+from event_util import Waker
+from mplayer_util import is_audio_file
+from settings import SONGS_JSON, LIBRARY_DEBOUNCE_SECONDS, LIBRARY_POLL_SECONDS, LOUDNESS_ANALYSIS, LOUDNESS_WORKERS
+
+INDEX_VERSION = 1
+
+
+class LibraryIndex():
+    """dirs maps the path of every directory (relative to base_dir, "" for base_dir itself) to
+    {"mtime_ns": ..., "subdirs": [names], "files": {name: {"mtime_ns": ..., "size": ...}}} - the dict of a file is
+    also where information about it can be cached."""
+
+    def __init__(self, base_dir, index_file=SONGS_JSON):
+        self.base_dir = base_dir
+        self.index_file = index_file
+        self.dirs = {}
+        self.scanned_dirs = 0
+        self.reused_dirs = 0
+
+    def load(self):
+        try:
+            with open(self.index_file, "r") as rfile:
+                index = json.load(rfile)
+        except (FileNotFoundError, ValueError):
+            return False
+        if index.get("version") != INDEX_VERSION or index.get("base_dir") != self.base_dir:
+            return False
+        self.dirs = index["dirs"]
+        return True
+
+    def save(self):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as wfile:
+            json.dump({"version": INDEX_VERSION, "base_dir": self.base_dir, "dirs": self.dirs}, wfile)
+        os.replace(tmp_file, self.index_file)
+
+    def scan(self, force_dirs=()):
+        """brings the index up to date, returns whether anything changed. force_dirs are listed again even if their
+        mtime did not change (eg. because a file in them was rewritten)"""
+        old_dirs, new_dirs = self.dirs, {}
+        self.scanned_dirs = self.reused_dirs = 0
+        visited = set()
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            full_dir = os.path.join(self.base_dir, rel_dir)
+            try:
+                stat = os.stat(full_dir)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:  # symlink loop
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            old = old_dirs.get(rel_dir)
+            if old is not None and old["mtime_ns"] == stat.st_mtime_ns and rel_dir not in force_dirs:
+                new_dirs[rel_dir] = old
+                self.reused_dirs += 1
+            else:
+                new_dirs[rel_dir] = self._scan_dir(full_dir, stat.st_mtime_ns, old)
+                self.scanned_dirs += 1
+            stack.extend(os.path.join(rel_dir, name) for name in new_dirs[rel_dir]["subdirs"])
+        self.dirs = new_dirs
+        return self.scanned_dirs > 0 or new_dirs.keys() != old_dirs.keys()
+
+    @staticmethod
+    def _scan_dir(full_dir, mtime_ns, old):
+        old_files = old["files"] if old else {}
+        subdirs, files = [], {}
+        try:
+            entries = list(os.scandir(full_dir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file() and is_audio_file(entry.name):
+                    stat = entry.stat()
+                    info = old_files.get(entry.name)
+                    if info is None or info["mtime_ns"] != stat.st_mtime_ns or info["size"] != stat.st_size:
+                        info = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+                    files[entry.name] = info
+            except OSError:  # vanished in the meantime
+                continue
+        return {"mtime_ns": mtime_ns, "subdirs": sorted(subdirs), "files": files}
+
+    def songs(self):
+        """all audio files, as paths relative to base_dir"""
+        return sorted(os.path.join(rel_dir, name) for rel_dir, entry in self.dirs.items() for name in entry["files"])
+
+    def file_info(self, song):
+        rel_dir, name = os.path.split(song)
+        entry = self.dirs.get(rel_dir)
+        return entry["files"].get(name) if entry else None
+
+    def metadata(self, song):
+        """the result of extract_metadata for song (path relative to base_dir), None if it is not known (yet)"""
+        info = self.file_info(song)
+        return info.get("meta") if info else None
+
+    def update_metadata(self, workers=None, cancelled=None):
+        """extracts the metadata of all files that don't have it yet (new ones, or ones whose mtime or size changed, as
+        scan() gives them a new dict), in a pool of `workers` processes (default: one per core). Stops early once
+        cancelled() returns True - the rest is done the next time. Returns how many were done."""
+        return self._update("meta", extract_metadata, workers, cancelled=cancelled)
+
+    def update_loudness(self, workers=None, cancelled=None):
+        """like update_metadata, for loudness_util.analyse_loudness. As that decodes the whole song it takes a while,
+        so the index is saved every now and then to not lose the progress."""
+        from loudness_util import analyse_loudness  # needs numpy
+        return self._update("loudness", analyse_loudness, workers, save_every=50, cancelled=cancelled)
+
+    def _update(self, key, function, workers=None, save_every=None, cancelled=None):
+        todo = [(rel_dir, name) for rel_dir, entry in self.dirs.items()
+                for name, info in entry["files"].items() if key not in info]
+        if not todo:
+            return 0
+        workers = workers or os.cpu_count() or 1
+        # only as many in flight as there are workers (pool.map would queue them all), so cancelling only has to wait for
+        # the ones that are running already
+        todo = iter(todo)
+        in_flight = deque()
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=lower_priority) as pool:
+            for rel_dir, name in itertools.islice(todo, workers):
+                in_flight.append((rel_dir, name, pool.submit(function, os.path.join(self.base_dir, rel_dir, name))))
+            while in_flight:
+                rel_dir, name, future = in_flight.popleft()
+                self.dirs[rel_dir]["files"][name][key] = future.result()
+                done += 1
+                if save_every and done % save_every == 0:
+                    self.save()
+                if cancelled and cancelled():
+                    break
+                for rel_dir, name in itertools.islice(todo, 1):
+                    in_flight.append((rel_dir, name, pool.submit(function, os.path.join(self.base_dir, rel_dir, name))))
+        return done
+
+
+def lower_priority():
+    """the workers should not take the CPU away from the player"""
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def load_library(base_dir, index_file=SONGS_JSON):
+    index = LibraryIndex(base_dir, index_file)
+    index.load()
+    if index.scan():
+        index.save()
+    return index
+
+
+# Metadata
+##########################################################################
+
+_MP3_BITRATES = {  # kbit/s by bitrate-index, for layer III
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+_MP3_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+_ID3_TEXT_FRAMES = {b"TIT2": "title", b"TPE1": "artist", b"TALB": "album",
+                    b"TT2": "title", b"TP1": "artist", b"TAL": "album"}
+_ID3_ENCODINGS = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}
+
+
+def extract_metadata(path):
+    """{"duration": seconds, "sample_rate", "channels", "bitrate": bit/s, "tags": {"title", "artist", "album"}}, with
+    None for what could not be found out. Reads wav and mp3 headers directly, asks ffprobe for everything else.
+    Runs in the worker processes of LibraryIndex.update_metadata, so it must never raise."""
+    meta = {"duration": None, "sample_rate": None, "channels": None, "bitrate": None, "tags": {}}
+    try:
+        ext = path.rsplit(".", 1)[-1].lower()
+        if ext == "wav":
+            meta.update(_wav_metadata(path))
+        elif ext == "mp3":
+            meta.update(_mp3_metadata(path))
+        else:
+            meta.update(_ffprobe_metadata(path))
+    except Exception as e:
+        meta["error"] = f"{type(e).__name__}: {e}"
+    return meta
+
+
+def _wav_metadata(path):
+    with wave.open(path, "rb") as wav:
+        rate, channels = wav.getframerate(), wav.getnchannels()
+        return {"duration": wav.getnframes() / rate, "sample_rate": rate, "channels": channels,
+                "bitrate": rate * channels * wav.getsampwidth() * 8}
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _id3v2_tags(tag, major):
+    tags = {}
+    pos = 0
+    id_size, header_size = (3, 6) if major == 2 else (4, 10)
+    while pos + header_size <= len(tag) and tag[pos] != 0:
+        frame_id = tag[pos:pos + id_size]
+        if major == 2:
+            size = int.from_bytes(tag[pos + 3:pos + 6], "big")
+        elif major == 4:
+            size = _syncsafe(tag[pos + 4:pos + 8])
+        else:
+            size = int.from_bytes(tag[pos + 4:pos + 8], "big")
+        data = tag[pos + header_size:pos + header_size + size]
+        if frame_id in _ID3_TEXT_FRAMES and data:
+            text = data[1:].decode(_ID3_ENCODINGS.get(data[0], "latin-1"), errors="replace").split("\0")[0].strip()
+            if text:
+                tags[_ID3_TEXT_FRAMES[frame_id]] = text
+        pos += header_size + size
+    return tags
+
+
+def _mp3_frame_header(data, pos):
+    """(version, sample_rate, bitrate, channels, frame_length, samples_per_frame) of the layer III frame at pos"""
+    if data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version = _MP3_VERSIONS.get((data[pos + 1] >> 3) & 3)
+    if version is None or (data[pos + 1] >> 1) & 3 != 1:  # only layer III
+        return None
+    bitrate_index, rate_index = data[pos + 2] >> 4, (data[pos + 2] >> 2) & 3
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _MP3_BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    padding = (data[pos + 2] >> 1) & 1
+    channels = 1 if data[pos + 3] >> 6 == 3 else 2
+    samples = 1152 if version == 1 else 576
+    return version, sample_rate, bitrate, channels, samples // 8 * bitrate // sample_rate + padding, samples
+
+
+def _mp3_metadata(path):
+    size = os.path.getsize(path)
+    tags = {}
+    with open(path, "rb") as rfile:
+        data = rfile.read(10)
+        audio_start = 0
+        if data[:3] == b"ID3" and len(data) == 10:
+            tag_size = _syncsafe(data[6:10])
+            tag = rfile.read(tag_size)
+            if data[5] & 0x40 and data[3] in (3, 4):  # extended header
+                tag = tag[(_syncsafe(tag[:4]) if data[3] == 4 else int.from_bytes(tag[:4], "big") + 4):]
+            tags = _id3v2_tags(tag, data[3])
+            audio_start = 10 + tag_size + (10 if data[5] & 0x10 else 0)
+        rfile.seek(audio_start)
+        data = rfile.read(65536)
+        rfile.seek(max(0, size - 128))
+        id3v1 = rfile.read(128)
+    end = size - 128 if id3v1[:3] == b"TAG" else size
+    if id3v1[:3] == b"TAG" and not tags:
+        for key, (start, stop) in (("title", (3, 33)), ("artist", (33, 63)), ("album", (63, 93))):
+            text = id3v1[start:stop].split(b"\0")[0].decode("latin-1").strip()
+            if text:
+                tags[key] = text
+    # first frame header that is followed by another valid one
+    for pos in range(len(data) - 4):
+        header = _mp3_frame_header(data, pos)
+        if header and (pos + header[4] + 4 > len(data) or _mp3_frame_header(data, pos + header[4])):
+            break
+    else:
+        raise ValueError("no mp3 frame found")
+    version, sample_rate, bitrate, channels, _, samples = header
+    # VBR files start with a Xing/Info or VBRI frame that knows the number of frames
+    side_info = (32 if channels == 2 else 17) if version == 1 else (17 if channels == 2 else 9)
+    frames = None
+    xing = pos + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info") and data[xing + 7] & 1:
+        frames = int.from_bytes(data[xing + 8:xing + 12], "big")
+    elif data[pos + 36:pos + 40] == b"VBRI":
+        frames = int.from_bytes(data[pos + 50:pos + 54], "big")
+    audio_bytes = end - audio_start - pos
+    if frames:
+        duration = frames * samples / sample_rate
+        bitrate = int(audio_bytes * 8 / duration) if duration else bitrate
+    else:
+        duration = audio_bytes * 8 / bitrate
+    return {"duration": duration, "sample_rate": sample_rate, "channels": channels, "bitrate": bitrate, "tags": tags}
+
+
+def _ffprobe_metadata(path):
+    out = subprocess.run(["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", path],
+                         stdout=subprocess.PIPE, check=True).stdout
+    probe = json.loads(out)
+    fmt = probe.get("format", {})
+    stream = next((i for i in probe.get("streams", []) if i.get("codec_type") == "audio"), {})
+    tags = {k.lower(): v for k, v in fmt.get("tags", {}).items() if k.lower() in ("title", "artist", "album")}
+    return {"duration": float(fmt["duration"]) if "duration" in fmt else None,
+            "sample_rate": int(stream["sample_rate"]) if "sample_rate" in stream else None,
+            "channels": stream.get("channels"),
+            "bitrate": int(fmt["bit_rate"]) if "bit_rate" in fmt else None,
+            "tags": tags}
+
+
+# Watching for changes
+##########################################################################
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT_STRUCT = struct.Struct("iIII")  # wd, mask, cookie, len - followed by len bytes of name
+
+
+class Inotify():
+    """minimal ctypes-wrapper around linux' inotify. Raises OSError if it is not available."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify only exists on linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def read_events(self):
+        """all (wd, mask, name) that are available right now"""
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = _EVENT_STRUCT.unpack_from(data, pos)
+                pos += _EVENT_STRUCT.size
+                events.append((wd, mask, data[pos:pos + length].rstrip(b"\0")))
+                pos += length
+
+    def close(self):
+        os.close(self._fd)
+
+
+class LibraryWatcher():
+    """Keeps a LibraryIndex (including the songs' metadata and loudness) up to date while the Leierkasten runs and calls on_change with the new list of songs
+    whenever it changed. Uses inotify (a watch on every directory) to wait for changes and falls back to re-scanning
+    every LIBRARY_POLL_SECONDS without it. After the first event it waits until no new events came in for
+    LIBRARY_DEBOUNCE_SECONDS, so that copying a whole album results in one update. All the scanning happens in the
+    watcher's own thread. The metadata and loudness analysis runs in there as well, but gives way to every change in the
+    library and to stop(), and goes on after the change was handled."""
+
+    def __init__(self, index, on_change, debounce=LIBRARY_DEBOUNCE_SECONDS, poll_interval=LIBRARY_POLL_SECONDS,
+                 analyse_loudness=LOUDNESS_ANALYSIS):
+        self.index = index
+        self.analyse_loudness = analyse_loudness
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._songs = index.songs()
+        self._waker = Waker()
+        self._stopped = threading.Event()
+        self._watches = {}  # wd -> directory relative to base_dir
+        try:
+            self._inotify = Inotify()
+        except OSError as e:
+            print(f"No inotify ({e}), polling the library every {poll_interval}s instead.")
+            self._inotify = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._waker.wake()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._inotify:
+            self._inotify.close()
+        self._waker.close()
+
+    def _add_watches(self):
+        watched = set(self._watches.values())
+        for rel_dir in self.index.dirs:
+            if rel_dir not in watched:
+                try:
+                    self._watches[self._inotify.add_watch(os.path.join(self.index.base_dir, rel_dir))] = rel_dir
+                except OSError as e:
+                    print(f"Cannot watch {rel_dir}: {e}", file=sys.stderr)
+
+    def _wait_for_changes(self, selector):
+        """blocks until something changed and settled down, returns the directories in which it happened"""
+        changed_dirs = set()
+        deadline = None
+        while not self._stopped.is_set():
+            timeout = None if deadline is None else max(0, deadline - monotonic())
+            ready = selector.select(timeout)
+            if not ready:  # debounce time is over
+                return changed_dirs
+            for key, _ in ready:
+                if key.fileobj is self._waker:
+                    self._waker.drain()
+                    continue
+                for wd, mask, _ in self._inotify.read_events():
+                    if mask & IN_IGNORED:  # directory is gone
+                        self._watches.pop(wd, None)
+                    elif wd in self._watches:
+                        changed_dirs.add(self._watches[wd])
+                deadline = monotonic() + self.debounce
+        return changed_dirs
+
+    def _update_metadata(self, selector):
+        """until it is done, or something changed in the library (which is in the selector) or stop() was called"""
+        def cancelled():
+            return self._stopped.is_set() or bool(selector and selector.select(0))
+        try:
+            if self.index.update_metadata(cancelled=cancelled):
+                self.index.save()
+            if self.analyse_loudness and not cancelled() and \
+                    self.index.update_loudness(workers=LOUDNESS_WORKERS, cancelled=cancelled):
+                self.index.save()
+        except Exception as e:
+            print(f"Could not analyse the songs: {e}", file=sys.stderr)
+
+    def _refresh(self, changed_dirs, selector):
+        try:
+            if self.index.scan(force_dirs=changed_dirs):
+                self.index.save()
+                if selector:
+                    self._add_watches()
+        except OSError as e:
+            print(f"Could not update the library: {e}", file=sys.stderr)
+            return
+        songs = self.index.songs()
+        if songs != self._songs:
+            print(f"Library changed, now {len(songs)} songs.")
+            self._songs = songs
+            self.on_change(songs)
+        self._update_metadata(selector)  # whatever a cancelled one left over, too
+
+    def _run(self):
+        selector = None
+        if self._inotify:
+            selector = selectors.DefaultSelector()
+            selector.register(self._inotify, selectors.EVENT_READ)
+            selector.register(self._waker, selectors.EVENT_READ)
+            self._add_watches()
+        # the watches are there before the first scan, so nothing added since load_library() gets lost. The analysis
+        # happens in here rather than at startup, as a cold library can take a while
+        self._refresh(set(), selector)
+        while not self._stopped.is_set():
+            if selector:
+                changed_dirs = self._wait_for_changes(selector)
+            else:
+                changed_dirs = set()
+                self._stopped.wait(self.poll_interval)
+            if self._stopped.is_set():
+                break
+            self._refresh(changed_dirs, selector)
+        if selector:
+            selector.close()
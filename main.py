@@ -1,46 +1,46 @@
+import atexit
 import os
+import signal
 import sys
-from time import sleep, time
+from time import monotonic, perf_counter, sleep, time
 import serial
-import re
+import selectors
 import threading
-from queue import Queue
+from queue import Queue, Empty
+from typing import NamedTuple
 from serial.serialutil import SerialException
 
-from mplayer_util import SimpleMplayerSlaveModePlayer
-import json
-from settings import BASE_DIR, SPEED_FACTOR
-import subprocess
+from mplayer_util import SimpleMplayerSlaveModePlayer, IdleMplayerSlaveModePlayer
+from slave_util import OutputDrain, CommandDropped
+from library_util import load_library, LibraryWatcher
+from event_util import Waker, Latest, ProcessSupervisor
+from serial_util import SerialReader, RPM, COUNTS, BUTTON_RELEASED, TEXT
+from rpm_util import RpmEstimator
+from speed_util import SpeedController, PlaybackClock, SpeedCurve
+from trace_util import TraceRecorder
+from metrics_util import Registry, serve_metrics
+from timeline_util import TRACER
+from settings import BASE_DIR, PLAYER, PRELOAD_BEFORE_END_SECONDS, SERIAL_PORT, SERIAL_TRACE, METRICS_ADDRESS, \
+    TIMELINE_TRACE
 
 # TODO: long button-press switches between nomove = [pause, veeeryslow, 1xspeed]
 # TODO: das mit dem moving average arduino-seitig besser machen (see jakobs messages)
 # TODO: der arm braucht mehr drehwiederstand
 
-def execute(cmd, **kwargs):
-    popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, **kwargs)
-    for stdout_line in iter(popen.stdout.readline, ""):
-        yield stdout_line.strip()
-    popen.stdout.close()
-    return_code = popen.wait()
-    if return_code:
-        raise subprocess.CalledProcessError(return_code, cmd)
-    
-def crawl_songs(base_dir):
-    # TODO: assert dass in den filenames keine kommas sind geez
-    return (" ".join(line for line in execute(["ls", "-m", base_dir])).split(", "))
-
 class SoundOrVideoTag():
     def __init__(self, filename):
         self.filename = filename
 
 def main():
-    # with open("songs.json", "r") as rfile:
-    #     songs = json.load(rfile)
+    if TIMELINE_TRACE:
+        signal.signal(signal.SIGUSR1, lambda *_: TRACER.dump(TIMELINE_TRACE))
+        atexit.register(TRACER.dump, TIMELINE_TRACE)
     while True:
         try:
-            songs = crawl_songs(BASE_DIR)
+            library = load_library(BASE_DIR)
+            songs = library.songs()
             print(songs)
-            kasten = Leierkasten(BASE_DIR, songs)
+            kasten = Leierkasten(BASE_DIR, songs, serial_port=SERIAL_PORT, library=library)
             kasten.play()
             kasten.run()
         except Exception as e:
@@ -51,182 +51,425 @@ def main():
 def done_callback():
     print("DONE!!!")
 
-class NullContextManager(object):
-    def __init__(self, dummy_resource=None):
-        self.dummy_resource = dummy_resource
-    def __enter__(self):
-        return self.dummy_resource
-    def __exit__(self, *args):
-        pass
+RESYNC_RETRY_SECONDS = 0.1  # how often the playback_thread checks if the player's queue has room for a lost song change
+
+# Messages to the playback_thread. It alone talks to the player and changes is_pausing, song_index and the songs, the
+# other threads only post() these to it - so nothing they do ever waits for the player. The RPM doesn't go through here
+# but through a Latest, as only the newest one matters.
+class Play(NamedTuple):
+    index: int = 0
+
+class NextSong(NamedTuple):
+    must_pause: bool = True  # the button pauses the current song and loads the next one, a song end just plays it
+
+class SongEnded(NamedTuple):
+    pass
+
+class SetSongs(NamedTuple):
+    songs: tuple
+
+class PlayerExited(NamedTuple):
+    process: object  # the subprocess.Popen
+    returncode: int
+
+class CommandFailed(NamedTuple):
+    line: str
+    error: Exception
 
 class Leierkasten():
 
-    def __init__(self, base_dir, songs, rpm_for_1 = 20, serial_port = None, baudrate = 115200, default_rpm = 20, song_index = 0):
+    def __init__(self, base_dir, songs, rpm_for_1 = 20, serial_port = None, baudrate = 115200, default_rpm = 20, song_index = 0, library = None):
         self.song_index = song_index
         self.songs = songs
+        self.library = library  # if given, a LibraryWatcher updates the songs while running
         if serial_port is None:
             serial_port = "/dev/"+[i for i in os.listdir("/dev") if "ttyUSB" in i][0]
         self.base_dir = base_dir
         self.rpm_for_1 = rpm_for_1
+        self.speed_curve = SpeedCurve(rpm_for_1)
         self.ser = serial.Serial(serial_port, baudrate)
-        self.rpm_queue = Queue()
-        self.cmd_queue = Queue()
+        self.serial_reader = SerialReader(self.ser, trace=TraceRecorder(SERIAL_TRACE, append=True) if SERIAL_TRACE else None)
+        self.rpm_estimator = RpmEstimator()
+        self.raw_counts = False  # True once the firmware sends raw counts, its averages are ignored from then on
+        self.inbox = Queue()  # (perf_counter() when posted, message) for the playback_thread
         self.kill_queue = Queue()
-        self.mplayerout_queue = Queue()
-        self.lock = threading.Lock()
-        # self.last_rpm_update_time = time()
+        self.metrics = Registry()
+        # instead of polling the inbox every 50ms, the playback_thread sleeps until something is posted to it
+        self.wakeup = threading.Event()
+        self.rpm = Latest(default_rpm, on_publish=self.wakeup.set)
+        self.speed = Latest(1.0)  # the last speed sent to the player
+        self.serial_waker = Waker()
+        self.player_waker = Waker()
+        self.last_rpm_update_time = time()
         self.player = setup_player(base_dir)
+        self.player.on_process_started = self._player_started
+        self.player.on_command_failed = lambda line, error: self.post(CommandFailed(line, error))
+        self.player_output = None  # the print_mplayer_thread's OutputDrain, with the last lines mplayer printed
+        self.speed_controller = SpeedController(self.send_speed)
         self.default_rpm = default_rpm
         self.is_pausing = True
+        self.preloaded = False  # whether the player continues with the next song by itself
+        self.playback_clock = PlaybackClock()
+        self.preload_at = None  # position in the current song at which the next one gets preloaded
+        self.resync_song = False  # a song change never reached the player, it gets the current song again
+        self.playback_error = None  # what the playback_thread died of
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        """everything that is counted somewhere anyway is only read when the metrics are read"""
+        metrics = self.metrics
+        metrics.gauge("leierkasten_queue_depth", "Items waiting in the queues between the threads",
+                      {"queue": "inbox"}, self.inbox.qsize)
+        self.message_wait = metrics.histogram("leierkasten_message_wait_seconds",
+                                              "Time from posting a message until the playback_thread handles it")
+        self.rpm_age = metrics.histogram("leierkasten_rpm_age_seconds",
+                                         "Age of a new RPM value when the playback_thread picks it up")
+        self.rpm_conflated = metrics.counter("leierkasten_rpm_conflated_total",
+                                             "RPM values that were overwritten before the playback_thread saw them")
+        metrics.gauge("leierkasten_rpm", "The newest RPM", function=lambda: self.rpm.value)
+        metrics.gauge("leierkasten_playback_speed", "The last speed sent to the player", function=lambda: self.speed.value)
+        self.loop_seconds = {thread: metrics.histogram("leierkasten_loop_seconds", "Time per loop iteration, without "
+                                                       "the waiting", {"thread": thread})
+                             for thread in ("playback", "read_rpm", "print_mplayer")}
+        self.commands_sent = {command: metrics.counter("leierkasten_player_commands_total", "Commands sent to the player",
+                                                       {"command": command})
+                              for command in ("play", "loadfile", "pause", "speed_set", "preload")}
+        self.command_failures = {reason: metrics.counter("leierkasten_player_command_failures_total",
+                                                         "Commands that did not reach the player", {"reason": reason})
+                                 for reason in ("dropped", "broken_pipe", "error")}
+        writer = getattr(self.player, "writer", None)
+        if writer:
+            metrics.gauge("leierkasten_queue_depth", "Items waiting in the queues between the threads",
+                          {"queue": "player_commands"}, writer.qsize)
+            for result in writer.stats:
+                metrics.counter("leierkasten_player_writer_commands_total", "Commands by what the player's writer did "
+                                "with them", {"result": result}, function=lambda result=result: writer.stats[result])
+        self.player_exits = metrics.counter("leierkasten_player_process_exits_total", "Player processes that exited")
+        self.player_starts = metrics.counter("leierkasten_player_process_starts_total",
+                                             "Player processes started, more than one (per song for PLAYER=\"mplayer\") "
+                                             "means it was restarted")
+        reader, parser = self.serial_reader, self.serial_reader.parser
+        metrics.counter("leierkasten_serial_bytes_total", "Bytes read from the serial port", function=lambda: reader.bytes_read)
+        metrics.counter("leierkasten_serial_reads_total", "Reads from the serial port", function=lambda: reader.reads)
+        metrics.counter("leierkasten_serial_lines_total", "Text lines from the serial port", function=lambda: parser.lines)
+        metrics.counter("leierkasten_serial_frames_total", "Binary frames from the serial port", function=lambda: parser.frames)
+        metrics.counter("leierkasten_serial_parse_errors_total", "Corrupted frames and lines from the serial port",
+                        function=lambda: parser.errors)
+        metrics.counter("leierkasten_player_output_bytes_total", "Bytes read from the player's stdout and stderr",
+                        function=lambda: self.player_output.bytes_read if self.player_output else 0)
+        for result in ("sent", "suppressed", "rate_limited"):
+            metrics.counter("leierkasten_speed_updates_total", "Speeds by what the SpeedController did with them",
+                            {"result": result}, function=lambda result=result: self.speed_controller.stats()[result])
+
+    def _player_started(self):
+        self.player_starts.inc()
+        self.player_waker.wake()
+
+    def post(self, message):
+        """hands a message to the playback_thread and wakes it up, never blocks"""
+        self.inbox.put((perf_counter(), message))
+        self.wakeup.set()
+
+    def kill(self):
+        self.kill_queue.put("kill")
+        self.wakeup.set()
+        self.serial_waker.wake()
+        self.player_waker.wake()
 
     def play(self, index=0):
+        self.post(Play(index))
+
+    def _play(self, index):
         song = SoundOrVideoTag(self.songs[index])
-        self.player.play(song, done_callback)
+        self.player.play(song, self.song_ended)
+        self.commands_sent["play"].inc()
         self.is_pausing = False
+        self.song_started()
+
+    def song_ended(self):
+        """on_done-callback for players that know by themselves when a song ended"""
+        self.post(SongEnded())
 
-    def next_song(self, must_pause=True, no_lock=False):
-        """!! only puts something in the command-queue such that _nextsong_mainthread is called !!"""
+    def song_started(self):
+        """sets the song's precomputed gain and preloads the next song PRELOAD_BEFORE_END_SECONDS before this one ends,
+        if the library knows how long it is"""
+        self.playback_clock.start()
+        self.preloaded = False
+        info = self.library.file_info(self.songs[self.song_index]) if self.library else None
+        gain_db = (info.get("loudness") or {}).get("gain_db") if info else None
+        self.player.set_gain(gain_db or 0.0)
+        meta = info.get("meta") if info else None
+        if meta and meta.get("duration"):
+            self.preload_at = max(0, meta["duration"] - PRELOAD_BEFORE_END_SECONDS)
+        else:
+            self.preload_at = None
+            self.preload_next()
+
+    def preload_in(self):
+        """seconds until the next song should be preloaded, None if nothing is scheduled"""
+        if self.preload_at is None:
+            return None
+        return self.playback_clock.seconds_until(self.preload_at)
+
+    def preload_next(self, replace=False):
+        if self.library and not getattr(self.player, "replaces_preload", True):
+            # the LibraryWatcher may change the next song after it was preloaded, and the player couldn't take it back
+            self.preloaded = False
+            return
+        self.preloaded = self.player.preload(SoundOrVideoTag(self.songs[(self.song_index + 1) % len(self.songs)]), replace)
+        if self.preloaded:
+            self.commands_sent["preload"].inc()
+
+    def update_songs(self, songs):
+        """called by the LibraryWatcher from its thread, the playback_thread takes over the new songs when it's ready"""
+        self.post(SetSongs(tuple(songs)))
+
+    def _set_songs(self, songs):
+        if not songs:
+            print("Library is empty, keeping the old songs.")
+            return
+        current = self.songs[self.song_index]
+        old_next = self.songs[(self.song_index + 1) % len(self.songs)]
+        self.songs = list(songs)
+        if current in songs:
+            self.song_index = songs.index(current)
+        else:  # the current one is gone, so the next song is the one that took its place
+            self.song_index = (self.song_index - 1) % len(songs)
+        if self.preloaded and songs[(self.song_index + 1) % len(songs)] != old_next:
+            self.preload_next(replace=True)
+
+    def next_song(self, must_pause=True):
+        """!! only posts a NextSong, the playback_thread changes the song in _next_song !!"""
+        self.post(NextSong(must_pause))
+
+    def _next_song(self, must_pause):
         self.song_index = (self.song_index + 1) % len(self.songs)
         song = SoundOrVideoTag(self.songs[self.song_index])
         print(f"Next song: {song.filename}")
-        with (self.lock if not no_lock else NullContextManager()):
-            if must_pause:
-                self.cmd_queue.put(("pause", f"play \"{os.path.join(self.base_dir, song.filename)}\""))
-            else:
-                self.cmd_queue.put(f"play \"{os.path.join(self.base_dir, song.filename)}\"")
-
-    def _nextsong_mainthread(self, cmd, must_pause=False):
         if must_pause:
             self.player.toggle_pause()
+            self.commands_sent["pause"].inc()
             self.is_pausing = not self.is_pausing
             # print(f"toggled pause - is now {self.is_pausing}")
-            # self.play(self.song_index)
-            newcommand = cmd.replace("play", "loadfile")+" 0"
-            # print(f"now executing {newcommand}")
-            try:
-                res = self.player.command(newcommand)
-                if res:
-                    self.mplayerout_queue.put("ended")
-            except BrokenPipeError as e:
-                print("killing..")
-                self.kill_queue.put("kill")
-                sleep(5)
-                raise e
+            self.player.command(f"loadfile \"{os.path.join(self.base_dir, song.filename)}\" 0")
+            self.commands_sent["loadfile"].inc()
             self.is_pausing = False
+            self.song_started()
         else:
-            self.play(self.song_index)
+            self._play(self.song_index)
+
+    def _command_failed(self, line, error):
+        """a command never reached the player. A dropped speed_set is sent again with the next update, a dropped song
+        change once the player's queue has room again (_resync_song). A broken pipe means the process is gone - which
+        _player_exited takes care of"""
+        if isinstance(error, CommandDropped):
+            self.command_failures["dropped"].inc()
+            if line.startswith("speed_set"):
+                self.speed_controller.invalidate()  # its last_sent is a speed the player never got
+            elif line.startswith("pause") or (line.startswith("loadfile") and line.endswith(" 0")):
+                self.resync_song = True
+            return
+        self.command_failures["broken_pipe" if isinstance(error, BrokenPipeError) else "error"].inc()
+        print(f"Command {line!r} failed: {error!r}")
+
+    def _resync_song(self):
+        """plays the current song again after a song change was dropped, once the player's queue has room for it"""
+        writer = getattr(self.player, "writer", None)
+        if writer and writer.qsize() >= writer.capacity // 2:
+            return
+        self.resync_song = False
+        print(f"Song change got lost, playing {self.songs[self.song_index]} again")
+        self._play(self.song_index)
+        self.speed_controller.invalidate()
+
+    def _player_exited(self, process, returncode):
+        """the player's process exited - returns whether that means the song ended: a player with a process per song
+        exits at its end. One that keeps its process for all songs crashed, it is restarted with the current song."""
+        self.player_exits.inc()
+        TRACER.instant("player exited", returncode=returncode)
+        if process is not self.player._process:
+            return False  # one that was replaced already
+        if returncode:
+            print(f"mplayer exited with return code {returncode}")
+            if self.player_output:
+                print(*self.player_output.tail(n=5), sep="\n", file=sys.stderr)
+        if getattr(self.player, "process_per_song", True):
+            return True
+        self._play(self.song_index)
+        self.speed_controller.invalidate()
+        return False
 
     def print_mplayer_thread(self):
+        """waits in select() on mplayer's stdout and stderr and for it to exit, every time the player starts a new
+        process it wakes us up through the player_waker so that we listen to the new one instead."""
+        selector = selectors.DefaultSelector()
+        selector.register(self.player_waker, selectors.EVENT_READ)
+        self.player_output = OutputDrain(selector, getattr(self.player, "slave", None), self._player_event)
+        supervisor = ProcessSupervisor(selector, lambda process, code: self.post(PlayerExited(process, code)))
         while self.kill_queue.empty():
-            if self.player._process:
-                line = self.player._process.stdout.readline()
-                if len(line) == 0:
-                    break
-                line = line.decode("UTF-8")
-                # print(line)
-                if "End of file" in line:
-                    self.mplayerout_queue.put("ended")
-            sleep(0.05)
-            # if not self.mplayerout_queue.empty():
-            #     line = self.mplayerout_queue.get()
-            #     print(line)
-            #     sleep(0.01)
-
+            process = self.player._process
+            if process is not self.player_output.process:
+                self.player_output.follow(process)
+                if process:
+                    supervisor.watch(process)
+            ready = selector.select()
+            started = perf_counter()
+            for key, _ in ready:
+                if key.fileobj is self.player_waker:
+                    self.player_waker.drain()
+                elif key.data is supervisor:
+                    supervisor.handle(key)
+                else:
+                    self.player_output.read(key)
+            self.loop_seconds["print_mplayer"].observe(perf_counter() - started)
+            TRACER.complete("player output", started, perf_counter() - started)
+        supervisor.close()
+        selector.close()
 
+    def _player_event(self, event, line):
+        """called by the OutputDrain for the lines of the player it recognises"""
+        TRACER.instant(f"song {event}")
+        if event == "ended":
+            self.post(SongEnded())
+        else:
+            print(f"mplayer: {line.decode('utf8', errors='replace')}")
 
     def read_rpm_thread(self):
-        last_rpm_update_time = time()
+        selector = selectors.DefaultSelector()
+        selector.register(self.serial_reader, selectors.EVENT_READ)
+        selector.register(self.serial_waker, selectors.EVENT_READ)
         while self.kill_queue.empty():
             try:
-                for trial in range(5):
-                    try:
-                        line = self.ser.readline()
-                    except SerialException:
-                        print(f"SerialException #{trial}! Waiting..")
-                        sleep(0.5)
-                    else:
-                        break
-
-                if line:
-                    try:
-                        serial_data = line.decode("UTF-8").strip()  # Read serial data
-                    except UnicodeDecodeError:
-                        print("UnicodeDecodeError!", file=sys.stderr)
+                ready = selector.select()
+                started = perf_counter()
+                for key, _ in ready:
+                    if key.fileobj is self.serial_waker:
+                        self.serial_waker.drain()
                         continue
-                    rpm_match = re.search(r'Average RPM \(Last (\d+) ms\): (-?\d+\.\d+)', serial_data)
-                    current_time = time()
-                    if rpm_match and current_time - last_rpm_update_time >= 0.5:
-                        with self.lock:
-                            rpm = abs(float(rpm_match.group(2)))  # Extract RPM value from serial data
-                            # TODO not abs, but treat negative as negative??
-                            print(f"RPM ({rpm_match.group(1)} ms interval): {rpm}")
-                            self.rpm_queue.put(rpm)  # Put RPM in the queue
-                            last_rpm_update_time = current_time
-                    elif re.search(r'button1_pressed', serial_data):
-                        pass
-                    elif re.search(r'button1_released', serial_data):
-                        self.next_song()
-                sleep(0.05)  # Sleep for 50 ms to avoid busy waiting
+                    events = []
+                    for trial in range(5):
+                        try:
+                            events = self.serial_reader.read_events()
+                        except SerialException:
+                            print(f"SerialException #{trial}! Waiting..")
+                            with TRACER.span("sleep", seconds=0.5):
+                                sleep(0.5)
+                        else:
+                            break
+                    self.handle_serial_events(events)
+                self.loop_seconds["read_rpm"].observe(perf_counter() - started)
+                TRACER.complete("serial", started, perf_counter() - started)
             except Exception as e:
                 print("!! Exception !!")
                 raise e
 
+        selector.close()
         print("read_rpm_thread ending!")
 
+    def handle_serial_events(self, events):
+        """handles a batch of events that arrived at once - of the RPM values only the newest one matters"""
+        rpm_event = None
+        estimated_rpm = None
+        for event in events:
+            kind = event[0]
+            TRACER.instant(kind)
+            if kind == COUNTS:
+                estimated_rpm = self.rpm_estimator.update(event[1], event[2])
+                self.raw_counts = True
+            elif kind == RPM:
+                rpm_event = event
+            elif kind == BUTTON_RELEASED:
+                self.next_song()
+            elif kind == TEXT:
+                print(f"Serial: {event[1].decode('UTF-8', errors='replace')}")
+        if self.raw_counts:
+            # a fresh estimate for every frame, the speed_controller decides which of them are worth a speed_set
+            if estimated_rpm is not None:
+                self.rpm.publish(estimated_rpm)
+            return
+        current_time = time()
+        if rpm_event and current_time - self.last_rpm_update_time >= 0.5:
+            rpm = abs(rpm_event[1])
+            # TODO not abs, but treat negative as negative??
+            print(f"RPM ({rpm_event[2]} ms interval): {rpm}")
+            self.rpm.publish(rpm)
+            self.last_rpm_update_time = current_time
+
+    def send_speed(self, speed):
+        """only queues the speed_set, the player's writer sends it (or drops it if mplayer doesn't read it in time)"""
+        self.player.set_speed(speed)
+        self.commands_sent["speed_set"].inc()
+        self.playback_clock.set_speed(speed)
+        self.speed.publish(speed)
+
     def playback_thread(self):
-        current_rpm = self.default_rpm
+        """the actor that owns the player: handles the messages of the other threads in the order they were posted, of
+        the RPM only the newest value. A hanging or dying player only ever blocks this thread."""
+        rpm_seq = 0
         while self.kill_queue.empty():
             try:
-                with self.lock:
-                    if not self.rpm_queue.empty():
-                        current_rpm = self.rpm_queue.get()
-
-                    if not self.cmd_queue.empty():
-                        cmd = self.cmd_queue.get()
-                        do_pause = False
-                        print(f"Received command: {cmd}")
-                        if isinstance(cmd, (list, tuple)) and cmd[0] == "pause":
-                            do_pause = True
-                            cmd = cmd[1]
-                        if cmd.startswith("play"):
-                            self._nextsong_mainthread(cmd, do_pause)
-                    if not self.mplayerout_queue.empty():
-                        while not self.mplayerout_queue.empty():
-                            self.mplayerout_queue.get()
-                        print("Song ended, next!")
-                        self.next_song(must_pause=False, no_lock=True)
+                # sleeps until something is posted, until the speed_controller may send a rate-limited speed or until
+                # the next song should be preloaded or a lost song change be retried
+                timeouts = [self.speed_controller.retry_in() if not self.is_pausing else None, self.preload_in(),
+                            RESYNC_RETRY_SECONDS if self.resync_song else None]
+                self.wakeup.wait(min((i for i in timeouts if i is not None), default=None))
+                self.wakeup.clear()
+                if not self.kill_queue.empty():
+                    break
+                started = perf_counter()
+                song_ended = False
+                while True:
+                    try:
+                        posted, message = self.inbox.get_nowait()
+                    except Empty:
+                        break
+                    self.message_wait.observe(perf_counter() - posted)
+                    if isinstance(message, SetSongs):
+                        self._set_songs(message.songs)
+                    elif isinstance(message, PlayerExited):
+                        song_ended |= self._player_exited(message.process, message.returncode)
+                    elif isinstance(message, CommandFailed):
+                        self._command_failed(message.line, message.error)
+                    elif isinstance(message, SongEnded):
+                        song_ended = True  # mplayer may report the same end more than once
+                    else:
+                        print(f"Received command: {message}")
+                        if isinstance(message, Play):
+                            self._play(message.index)
+                        else:
+                            self._next_song(message.must_pause)
+                        # mplayer starts every song with speed 1, so the speed needs to be re-sent
+                        self.speed_controller.invalidate()
+                if song_ended:
+                    print("Song ended, next!")
+                    if self.preloaded:  # the player already plays the next one
+                        self.song_index = (self.song_index + 1) % len(self.songs)
+                        print(f"Next song: {self.songs[self.song_index]}")
+                        self.song_started()
+                    else:
+                        self._next_song(must_pause=False)
+                    self.speed_controller.invalidate()
+                if self.resync_song:
+                    self._resync_song()
 
+                rpm = self.rpm.read()
+                if rpm.seq != rpm_seq:
+                    self.rpm_conflated.inc(rpm.seq - rpm_seq - 1)
+                    self.rpm_age.observe(monotonic() - rpm.timestamp)
+                    rpm_seq = rpm.seq
                 if not self.is_pausing:
-                    errored = False
-                    for outside_trial in range(1000):
-                        try:
-                            rpm_factor = current_rpm / self.rpm_for_1
-                            if rpm_factor == 0:
-                                speed = 0
-                            elif rpm_factor > 1:
-                                speed = abs(1 - rpm_factor) * SPEED_FACTOR + 1
-                            else:
-                                speed = 1 - (abs(1 - rpm_factor) * SPEED_FACTOR)
-                            # print(f"rpm_factor: {rpm_factor}, speed: {speed}")
-                            res = self.player.command(f"speed_set {speed}", ignore_exc=False)
-                            if res:
-                                self.mplayerout_queue.put("ended")
-                        except BrokenPipeError as e:
-                            if outside_trial < 2:
-                                sleep(0.1)
-                                errored = True
-                            else:
-                                print("Outside (playback-thread) died too often!")
-                                self.kill_queue.put("kill")
-                                sleep(10)
-                                break
-                        else:
-                            if errored:
-                                print("Escaped error")
-                            break
-                sleep(0.05)
+                    self.speed_controller.update(self.speed_curve(rpm.value))
+                if self.preload_in() == 0:
+                    self.preload_at = None
+                    self.preload_next()
+                self.loop_seconds["playback"].observe(perf_counter() - started)
+                TRACER.complete("playback", started, perf_counter() - started)
             except KeyboardInterrupt:
                 break
+            except Exception as e:  # run() raises it again, so that main() waits before it starts all over
+                self.playback_error = e
+                break
+        print(f"speed_set commands: {self.speed_controller.stats()}")
         print("playback_thread ended")
 
     @staticmethod
@@ -237,38 +480,65 @@ class Leierkasten():
         return min(adjusted_time, 0.2)  # Limit adjusted time to a maximum of 200 ms
 
     def run(self):
-        read_thread = threading.Thread(target=self.read_rpm_thread)
-        playback_thread = threading.Thread(target=self.playback_thread)
-        print_mplayer_thread = threading.Thread(target=self.print_mplayer_thread)
+        read_thread = threading.Thread(target=self.read_rpm_thread, name="read_rpm")
+        playback_thread = threading.Thread(target=self.playback_thread, name="playback")
+        print_mplayer_thread = threading.Thread(target=self.print_mplayer_thread, name="print_mplayer")
         read_thread.start()
         playback_thread.start()
         print_mplayer_thread.start()
+        watcher = LibraryWatcher(self.library, self.update_songs) if self.library else None
+        if watcher:
+            watcher.start()
+        metrics_server = serve_metrics(self.metrics, METRICS_ADDRESS) if METRICS_ADDRESS else None
 
         try:
             try:
-                while True:
-                    sleep(0.5)
+                playback_thread.join()  # returns once something killed the kasten, so that main() can restart it
             except KeyboardInterrupt:
                 print("KILLING")
-                self.kill_queue.put("kill")
+            self.kill()
             read_thread.join()
             playback_thread.join()
+            print_mplayer_thread.join()
+            if self.playback_error:
+                raise self.playback_error
         except KeyboardInterrupt:
             print("KILLED - Closing Serial!")
             self.ser.close()
-            self.kill_queue.put("kill")
+            self.kill()
         except Exception as e:
             print("EXCEPTION - Closing Serial!")
+            if self.player_output and self.player_output.tail():
+                print("Last output of mplayer:", *self.player_output.tail(), sep="\n", file=sys.stderr)
             self.ser.close()
-            self.kill_queue.put("kill")
+            self.kill()
             raise e
         else:
             print("ENDING")
             self.ser.close()
-            self.kill_queue.put("kill")
+            self.kill()
+        finally:
+            if watcher:
+                watcher.stop()
+            if metrics_server:
+                metrics_server.shutdown()
+                metrics_server.server_close()
+            if self.serial_reader.trace:
+                self.serial_reader.trace.close()
+            self.player.shutdown()
+            # main() builds a new Leierkasten after every error, the wakers' pipes must not pile up
+            for thread in (read_thread, playback_thread, print_mplayer_thread):
+                thread.join()
+            self.serial_waker.close()
+            self.player_waker.close()
 
 
 def setup_player(base_dir):
+    if PLAYER == "engine":
+        from audio_util import EnginePlayer  # needs numpy
+        return EnginePlayer(None, base_dir)
+    if PLAYER == "mplayer-idle":
+        return IdleMplayerSlaveModePlayer(None, base_dir)
     return SimpleMplayerSlaveModePlayer(None, base_dir)
 
 
@@ -0,0 +1,129 @@
+"""Counters, gauges and histograms of what the Leierkasten is doing, readable in the Prometheus text format.
+
+Recording is meant to be cheap enough for every loop iteration: a counter is an integer addition, a histogram a bisect
+and two additions, without locks (an increment from two threads at the very same time may get lost, which is fine for
+these numbers). Values that are counted somewhere anyway, like the queue sizes or the SerialReader's bytes, are not
+recorded at all but read through a function when somebody asks for them.
+
+With settings.METRICS_ADDRESS set, serve_metrics() answers HTTP GETs on it:
+
+    curl http://127.0.0.1:9456/metrics                              # METRICS_ADDRESS = "127.0.0.1:9456"
+    curl --unix-socket /tmp/leierkasten.sock http://localhost/      # METRICS_ADDRESS = "/tmp/leierkasten.sock"
+"""
+
+import os
+import socketserver
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Counter():
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.function() if self.function else self.value
+
+
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+
+class Histogram():
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self._counts):
+            total += count
+            yield f"{name}_bucket", labels + (("le", str(bound)),), total
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, total
+
+
+class Registry():
+    """All metrics by name. A name can have several label-combinations, eg. leierkasten_loop_seconds{thread="playback"}
+    and leierkasten_loop_seconds{thread="read_rpm"}, which have to be of the same type."""
+
+    def __init__(self):
+        self._families = {}  # name -> [type, help, {labels: metric}]
+
+    def _add(self, name, kind, help, labels, metric):
+        family = self._families.setdefault(name, [kind, help, {}])
+        if family[0] != kind:
+            raise ValueError(f"{name} is a {family[0]}, not a {kind}")
+        labels = tuple(sorted((labels or {}).items()))
+        return family[2].setdefault(labels, metric)
+
+    def counter(self, name, help, labels=None, function=None):
+        """a value that only grows. With function, the value is whatever it returns when the metrics are read"""
+        return self._add(name, "counter", help, labels, Counter(function))
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self._add(name, "gauge", help, labels, Gauge(function))
+
+    def histogram(self, name, help, labels=None, buckets=SECONDS_BUCKETS):
+        return self._add(name, "histogram", help, labels, Histogram(buckets))
+
+    def render(self):
+        """everything in the Prometheus text exposition format"""
+        lines = []
+        for name, (kind, help, metrics) in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics.items():
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in sample_labels)
+                    lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_metrics(registry, address):
+    """serves the registry over HTTP in a background thread, on "host:port" or on a Unix socket if address is a
+    path. Returns the server, shutdown() and server_close() it when done."""
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)  # left over from the last run
+        server = _UnixHTTPServer(address, _MetricsHandler)
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -12,6 +12,10 @@ import time
 from pathlib import Path
 from typing import Any, Callable
 
+from slave_util import SlaveClient, CommandWriter, SlaveError
+from settings import SPEED_COMMAND_DEADLINE_SECONDS
+from timeline_util import TRACER
+
 
 is_win = is_mac = False
 
@@ -78,6 +82,20 @@ class Player(ABC):
     def toggle_pause(self):
         "Optional."
 
+    def set_speed(self, speed: float):
+        "Optional."
+
+    def set_gain(self, gain_db: float):
+        "Optional. Volume of the current song, relative to how loud it is in the file."
+
+    def preload(self, tag, replace=False):
+        """Optional. Queue tag to be played once the current one ended.
+
+        replace: something else was preloaded before, which should not be played anymore. A player that can't take
+        back what it preloaded sets replaces_preload = False.
+        Returns True if the player will continue with tag by itself."""
+        return False
+
     def shutdown(self):
         "Do any cleanup required at program termination. Optional."
 
@@ -261,36 +279,33 @@ class SimpleMplayerPlayer(SimpleProcessPlayer, SoundOrVideoPlayer):
 ##########################################################################
 
 
+SOFTVOL_MAX = 300  # so that quiet songs can be amplified by up to 9.5 dB
+SOFTVOL_ARGS = ["-softvol", "-softvol-max", str(SOFTVOL_MAX)]
+
+
 class SimpleMplayerSlaveModePlayer(SimpleMplayerPlayer):
+    # called without arguments every time a new mplayer-process got started, so that whoever reads its stdout can switch to it
+    on_process_started = None
+    # called with (line, error) from the writer's thread for every command that could not be sent
+    on_command_failed = None
+    # the process exits at the end of the song
+    process_per_song = True
+
     def __init__(self, taskman, media_folder: str):
         self.media_folder = media_folder
         self.current_tag = None
         super().__init__(taskman, media_folder)
         self.args.append("-slave")
-
-
-    def _poll_stdfile(self, stdfile, poll_for = 1):
-        # text = ""
-        # poll_stdfile = select.poll()
-        # poll_stdfile.register(stdfile, select.POLLIN)
-        #
-        # start_time = time.time()
-        # line = ""
-        # while (time.time() < start_time + poll_for*1):
-        #     poll_result = poll_stdfile.poll(0)
-        #     if poll_result:
-        #         line = stdfile.readline()
-        #         if line:
-        #             text += line.decode("UTF-8")
-        # return text
-        for stdout_line in iter(stdfile.readline, ""):
-            if stdout_line:
-                print(stdout_line.strip())
-            else:
-                break
-        return ""
-
-
+        # commands are only queued, its thread writes them to the current process
+        self.writer = CommandWriter(on_failure=self._command_failed)
+        # answers to queries - whoever reads the process' stdout has to hand every line to slave.handle_line()
+        self.slave = SlaveClient(self._command)
+
+    def _command_failed(self, line, error):
+        if self.on_command_failed:
+            self.on_command_failed(line, error)
+        else:
+            print(f"Command {line!r} failed: {error!r}")
 
     def _play(self, tag):
         assert hasattr(tag, "filename")
@@ -298,8 +313,9 @@ class SimpleMplayerSlaveModePlayer(SimpleMplayerPlayer):
 
         filename = media_file_filter(tag.filename)
 
+        self.slave.reset()
         self._process = subprocess.Popen(
-            self.args + [filename],
+            self.args + SOFTVOL_ARGS + [filename],
             env=self.env,
             cwd=self.media_folder,
             stdin=subprocess.PIPE,
@@ -307,54 +323,123 @@ class SimpleMplayerSlaveModePlayer(SimpleMplayerPlayer):
             stderr=subprocess.PIPE,
             startupinfo=startup_info(),
         )
+        self.writer.attach(self._process.stdin)
+        if self.on_process_started:
+            self.on_process_started()
         # self._wait_for_termination(tag)
 
-    def _command(self, *args: Any, poll_outerr = False):
-        """Send a command over the slave interface.
+    def _command(self, *args: Any, poll_outerr = False, deadline=None, key=None, on_failure=None):
+        """Queue a command for the slave interface, see CommandWriter.submit. Returns right away, a broken pipe (or a
+        missed deadline) is reported to on_command_failed later.
 
         The trailing newline is automatically added."""
-        str_args = [str(x) for x in args]
+        line = " ".join(str(x) for x in args)
         if self._process:
-            for trial in range(1000):
-                try:
-                    self._process.stdin.write(" ".join(str_args).encode("utf8") + b"\n")
-                    self._process.stdin.flush()
-                except BrokenPipeError as e:
-                    if trial < 3:
-                        print(f"BrokenPipeError #{trial}! Waiting..")
-                        time.sleep(0.5)
-                    else:
-                        raise e
-                else:
-                    break
-
+            self.writer.submit(line, deadline, key, on_failure)
+        else:
+            self.writer.reject(line, SlaveError("no mplayer running"), on_failure)
         return "", ""
 
     def command(self, *args: Any, poll_outerr = False, ignore_exc=False):
-        """ignore_exc: I have the brokenpipeexception when trying to play a new song when there is no song playing.
-        While in that case it's relevant, it's not relevant for the speed_set command, there it should just nothing happen"""
-        try:
-            self._command(*args, poll_outerr=poll_outerr)
-        except BrokenPipeError as e:
-            if ignore_exc:
-                print("Ignoring the BrokenPipeErrors. (probably because its speed_set command")
-                return
-            print(f"Many BrokenPipeErrors. re-playing current one and re-executing - for command: {args}")
-            # print(f"Many BrokenPie")
-            try:
-                self.play(self.current_tag)
-            except AttributeError as e:
-                print("No current song to play, ignoring exception.")
-                # AttributeError: 'SimpleMplayerSlaveModePlayer' object has no attribute 'current_tag'
-                # should be the case for speed_set
-            else:
-                print("No exception on play, will assume song ended howver.")
-                self._command(*args, poll_outerr=poll_outerr)
-                return True
+        self._command(*args, poll_outerr=poll_outerr)
 
     def seek_relative(self, secs: int):
         self.command("seek", secs, 0)
 
+    def set_speed(self, speed: float):
+        # a newer speed replaces one that is still waiting, and one that waited too long is not worth sending anymore
+        self._command(f"speed_set {speed}", deadline=time.monotonic() + SPEED_COMMAND_DEADLINE_SECONDS, key="speed_set")
+
     def toggle_pause(self):
         self.command("pause")
 
+    def set_gain(self, gain_db: float):
+        # with -softvol, mplayer's volume v means a linear factor of v/100 * softvol_max/100
+        volume = 100 * 10 ** (gain_db / 20) * 100 / SOFTVOL_MAX
+        self.command("volume", f"{min(max(volume, 0), 100):.2f}", 1)
+
+    def get_time_pos(self):
+        "Future for the position in the current song, in seconds."
+        return self.slave.get_time_pos()
+
+    def get_time_length(self):
+        "Future for the length of the current song, in seconds."
+        return self.slave.get_time_length()
+
+    def get_property(self, name: str):
+        "Future for the value of an mplayer property, as a string."
+        return self.slave.get_property(name)
+
+    def shutdown(self):
+        self.writer.stop()
+
+
+
+# Mplayer in slave- and idle-mode, one process for all songs
+##########################################################################
+
+
+class IdleMplayerSlaveModePlayer(SimpleMplayerSlaveModePlayer):
+    """Keeps one mplayer running in -idle mode for all songs and switches them with `loadfile`, so a new song costs no
+    fork/exec and there is no dead pipe between two songs. With -msglevel global=6 mplayer prints "EOF code: 1" when a
+    song played through (a `loadfile` replacing it gives a different code)."""
+
+    idle_args = ["-idle", "-msglevel", "global=6"] + SOFTVOL_ARGS
+    process_per_song = False
+    # mplayer can only append to its playlist: a preloaded song can't be taken back, it plays when the current one ends
+    replaces_preload = False
+
+    def _start_process(self):
+        self.slave.reset()
+        self._process = subprocess.Popen(
+            [i for i in self.args if i != "-slave"] + ["-slave"] + self.idle_args,
+            env=self.env,
+            cwd=self.media_folder,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            startupinfo=startup_info(),
+        )
+        self.writer.attach(self._process.stdin)
+        if self.on_process_started:
+            self.on_process_started()
+
+    def _play(self, tag):
+        assert hasattr(tag, "filename")
+        self.current_tag = tag
+        self._command("loadfile", f'"{media_file_filter(tag.filename)}"', 0)
+
+    def preload(self, tag, replace=False):
+        if replace:  # mplayer can only append to its playlist, so Leierkasten has to loadfile the next song itself
+            return False
+        self._command("loadfile", f'"{media_file_filter(tag.filename)}"', 1)
+        return True
+
+    def _command(self, *args: Any, poll_outerr = False, deadline=None, key=None, on_failure=None):
+        """Queue a command for the slave interface, (re-)starting mplayer if it is not running - with the current song,
+        unless the command replaces that anyway (a preloading `loadfile ... 1` doesn't)."""
+        line = " ".join(str(x) for x in args)
+        if self._process is None or self._process.poll() is not None:
+            if self._process is not None:
+                print(f"mplayer died with return code {self._process.returncode}, restarting it.")
+                TRACER.instant("player restart", returncode=self._process.returncode)
+            self._start_process()
+            replaces_song = line.startswith("loadfile") and line.endswith(" 0")
+            if self.current_tag is not None and not replaces_song:
+                self.writer.submit(f'loadfile "{media_file_filter(self.current_tag.filename)}" 0')
+        self.writer.submit(line, deadline, key, on_failure)
+        return "", ""
+
+    def command(self, *args: Any, poll_outerr = False, ignore_exc=False):
+        self._command(*args, poll_outerr=poll_outerr)
+
+    def shutdown(self):
+        if self._process is not None and self._process.poll() is None:
+            self._command("quit")
+            self.writer.flush(1)
+            try:
+                self._process.wait(1)
+            except subprocess.TimeoutExpired:
+                self._process.terminate()
+        self.writer.stop()
+        self._process = None
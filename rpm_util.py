@@ -0,0 +1,155 @@
+"""Estimating the crank's RPM on the pi from the raw encoder counts, instead of the firmware's moving average.
+
+With RAW_COUNTS enabled in ino_code/.../main.cpp the arduino sends a FRAME_COUNTS whenever the encoder moved (and a
+heartbeat every 100 ms if it didn't) with its millis() and the steps since the last frame. The RpmEstimator keeps the
+running step count in a numpy ring buffer and measures the rate over the shortest stretch that contains min_steps
+steps - short when cranking fast, up to max_window when cranking slowly - and then smooths that with an EWMA, an
+alpha-beta or a Kalman filter. It produces a new RPM for every frame, so the music follows the crank within a fraction
+of a second instead of the 0.5-10 s of the firmware's window.
+
+    python benchmarks/bench_rpm_estimator.py   # step-response lag compared to the firmware average
+"""
+
+import math
+
+import numpy as np
+
+from settings import STEPS_PER_REVOLUTION, RPM_ESTIMATOR, RPM_ESTIMATOR_MIN_STEPS, RPM_ESTIMATOR_MAX_WINDOW_SECONDS
+
+
+class RingBuffer():
+    """The last `capacity` (time, value) pairs in numpy arrays. Every pair is written twice, at i and i + capacity, so
+    that the newest n pairs are always one contiguous slice and never need to be copied together."""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        self._values = np.zeros(2 * capacity, dtype=np.float64)
+        self._index = capacity - 1  # of the newest pair in the second half
+        self.size = 0
+
+    def append(self, time, value):
+        self._index = self._index + 1 if self._index < 2 * self.capacity - 1 else self.capacity
+        self._times[self._index] = self._times[self._index - self.capacity] = time
+        self._values[self._index] = self._values[self._index - self.capacity] = value
+        if self.size < self.capacity:
+            self.size += 1
+
+    def last(self, n=None):
+        """views of the times and values of the newest n pairs (all of them by default), oldest first"""
+        n = self.size if n is None else min(n, self.size)
+        return self._times[self._index + 1 - n:self._index + 1], self._values[self._index + 1 - n:self._index + 1]
+
+
+class EwmaFilter():
+    """exponentially weighted moving average with a time constant in seconds, so it works with irregular samples"""
+
+    def __init__(self, time_constant=0.15):
+        self.time_constant = time_constant
+        self.value = None
+
+    def update(self, measurement, dt):
+        if self.value is None:
+            self.value = measurement
+        else:
+            self.value += (1 - math.exp(-dt / self.time_constant)) * (measurement - self.value)
+        return self.value
+
+
+class AlphaBetaFilter():
+    """tracks the RPM and its rate of change, so a steady acceleration doesn't lag behind like with an average"""
+
+    def __init__(self, alpha=0.15, beta=0.01):
+        self.alpha = alpha
+        self.beta = beta
+        self.value = None
+        self.rate = 0.0
+
+    def update(self, measurement, dt):
+        if self.value is None:
+            self.value = measurement
+            return self.value
+        predicted = self.value + self.rate * dt
+        residual = measurement - predicted
+        self.value = predicted + self.alpha * residual
+        if dt > 0:
+            self.rate += self.beta * residual / dt
+        return self.value
+
+
+class KalmanFilter():
+    """constant-velocity Kalman filter over (RPM, RPM per second). process_noise is how much the crank's acceleration
+    may change per second (in RPM/s^2), measurement_noise the standard deviation of a measurement in RPM."""
+
+    def __init__(self, process_noise=40.0, measurement_noise=4.0):
+        self.q = process_noise ** 2
+        self.r = measurement_noise ** 2
+        self.value = None
+        self.rate = 0.0
+        self._p = None  # covariance as (p00, p01, p11)
+
+    def update(self, measurement, dt):
+        if self.value is None:
+            self.value = measurement
+            self._p = (self.r, 0.0, self.q)
+            return self.value
+        p00, p01, p11 = self._p
+        # predict, with the acceleration as white noise (discrete Wiener process acceleration model)
+        self.value += self.rate * dt
+        p00 += dt * (2 * p01 + dt * p11) + self.q * dt ** 4 / 4
+        p01 += dt * p11 + self.q * dt ** 3 / 2
+        p11 += self.q * dt ** 2
+        # correct
+        s = p00 + self.r
+        k0, k1 = p00 / s, p01 / s
+        residual = measurement - self.value
+        self.value += k0 * residual
+        self.rate += k1 * residual
+        self._p = ((1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01)
+        return self.value
+
+
+FILTERS = {"ewma": EwmaFilter, "alpha-beta": AlphaBetaFilter, "kalman": KalmanFilter}
+
+
+class RpmEstimator():
+    """Turns FRAME_COUNTS (arduino millis, encoder steps since the last frame) into an RPM on every frame. The direction
+    is ignored, like the rest of the Leierkasten does with negative RPM."""
+
+    def __init__(self, filter=RPM_ESTIMATOR, steps_per_revolution=STEPS_PER_REVOLUTION,
+                 min_steps=RPM_ESTIMATOR_MIN_STEPS, max_window=RPM_ESTIMATOR_MAX_WINDOW_SECONDS, capacity=1024):
+        self.filter = FILTERS[filter]() if isinstance(filter, str) else filter
+        self.steps_per_revolution = steps_per_revolution
+        self.min_steps = min_steps
+        self.max_window = max_window
+        self.buffer = RingBuffer(capacity)
+        self.rpm = 0.0
+        self._steps = 0
+        self._last_millis = None
+        self._time = 0.0
+
+    def update(self, millis, delta):
+        if self._last_millis is None:
+            dt = 0.0
+        else:
+            dt = ((millis - self._last_millis) & 0xFFFFFFFF) / 1000  # millis() wraps after 49 days
+        self._last_millis = millis
+        self._time += dt
+        self._steps += abs(delta)
+        self.buffer.append(self._time, self._steps)
+        self.rpm = max(0.0, self.filter.update(self.measure(), dt))
+        return self.rpm
+
+    def measure(self):
+        """the unfiltered RPM over the shortest stretch back from now that contains min_steps steps, at most max_window
+        seconds back. While the crank stands still, the stretch grows and the measurement falls off towards 0."""
+        times, steps = self.buffer.last()
+        now = times[-1]
+        # the first frame with the last count that is at least min_steps behind - not a heartbeat after it
+        start = np.searchsorted(steps, steps[-1] - self.min_steps, side="right") - 1
+        if start > 0:
+            start = np.searchsorted(steps, steps[start])
+        start = max(start, np.searchsorted(times, now - self.max_window), 0)
+        if start >= len(times) - 1 or now == times[start]:
+            return 0.0
+        return (steps[-1] - steps[start]) / self.steps_per_revolution * 60 / (now - times[start])
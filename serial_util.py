@@ -0,0 +1,189 @@
+"""Parsing of what the arduino sends over the serial port.
+
+The firmware either prints human readable lines ("Average RPM (Last 500 ms): 20.00", "button1_released", ...) or,
+with BINARY_PROTOCOL enabled in ino_code/.../main.cpp, compact frames:
+
+    SYNC (0xA5) | type | payload-length | payload | checksum
+
+where the checksum is the sum of type, length and payload bytes modulo 256. As SYNC is not ASCII it can never be part of
+a text line, so both formats can be mixed on the same stream (the DIP-switch dumps stay text in binary mode too).
+"""
+
+import os
+import struct
+
+from serial.serialutil import SerialException
+
+SYNC = 0xA5
+MAX_PAYLOAD = 32
+MAX_LINE = 256  # longer "lines" without newline are garbage
+
+FRAME_RPM = 0x01     # payload: float32 rpm, uint16 mean-interval in ms (little endian)
+FRAME_BUTTON = 0x02  # payload: uint8, 1 = pressed, 0 = released
+FRAME_WINDOW = 0x03  # payload: uint16 mean-interval in ms (after a DIP-switch change)
+FRAME_COUNTS = 0x04  # payload: uint32 millis(), int16 encoder steps since the last FRAME_COUNTS (with RAW_COUNTS)
+
+# events returned by SerialParser.feed, as tuples (kind, *values)
+RPM = "rpm"                            # (RPM, rpm, interval_ms)
+BUTTON_PRESSED = "button1_pressed"     # (BUTTON_PRESSED,)
+BUTTON_RELEASED = "button1_released"   # (BUTTON_RELEASED,)
+WINDOW = "window"                      # (WINDOW, interval_ms)
+COUNTS = "counts"                      # (COUNTS, millis, steps), see rpm_util.RpmEstimator
+TEXT = "text"                          # (TEXT, line) for every other line, as bytes
+
+_RPM_STRUCT = struct.Struct("<fH")
+_UINT16_STRUCT = struct.Struct("<H")
+_COUNTS_STRUCT = struct.Struct("<Ih")
+_RPM_PREFIX = b"Average RPM (Last "
+_RPM_INFIX = b" ms): "
+_SYNC_BYTES = bytes([SYNC])
+_BUTTON_PRESSED_BYTES = BUTTON_PRESSED.encode()
+_BUTTON_RELEASED_BYTES = BUTTON_RELEASED.encode()
+
+
+def build_frame(frame_type, payload=b""):
+    """the host-side counterpart of send_frame() in the firmware, for tests and replays"""
+    body = bytes([frame_type, len(payload)]) + payload
+    return _SYNC_BYTES + body + bytes([sum(body) & 0xFF])
+
+
+class SerialParser():
+    """Incremental parser for the mixed text/binary stream. Feed it whatever came from the serial port, in chunks of
+    any size, and it returns the events that are complete so far. Corrupted frames (bad checksum or length) are
+    skipped by resyncing on the next SYNC byte."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.lines = 0
+        self.errors = 0
+
+    def feed(self, data):
+        self._buffer += data
+        events, pos = self.parse(self._buffer, 0, len(self._buffer))
+        del self._buffer[:pos]
+        return events
+
+    def parse(self, buf, pos, n):
+        """parses the complete messages in buf[pos:n] in place. Returns the events and the position up to which buf
+        was consumed - everything after that is the beginning of a message that is not complete yet."""
+        events = []
+        while pos < n:
+            if buf[pos] == SYNC:
+                if n - pos < 3:
+                    break
+                length = buf[pos + 2]
+                if length > MAX_PAYLOAD:
+                    self.errors += 1
+                    pos += 1
+                    continue
+                end = pos + 3 + length  # index of the checksum
+                if end >= n:
+                    break
+                with memoryview(buf) as view:
+                    checksum = sum(view[pos + 1:end]) & 0xFF
+                if checksum != buf[end]:
+                    self.errors += 1
+                    pos += 1
+                    continue
+                event = self._decode_frame(buf[pos + 1], buf, pos + 3, length)
+                if event is None:
+                    self.errors += 1
+                else:
+                    self.frames += 1
+                    events.append(event)
+                pos = end + 1
+            else:
+                newline = buf.find(b"\n", pos, n)
+                sync = buf.find(_SYNC_BYTES, pos, newline if newline != -1 else n)
+                if sync != -1:  # a frame interrupted a text line, the part before it is garbage
+                    self.errors += 1
+                    pos = sync
+                    continue
+                if newline == -1:
+                    if n - pos > MAX_LINE:
+                        self.errors += 1
+                        pos = n
+                    break
+                end = newline
+                while end > pos and buf[end - 1] in b"\r ":
+                    end -= 1
+                if end > pos:
+                    self.lines += 1
+                    events.append(self._parse_line(buf, pos, end))
+                pos = newline + 1
+        return events, pos
+
+    @staticmethod
+    def _parse_line(buf, start, end):
+        """turns the text line buf[start:end] into an event, without regex or decoding it"""
+        if buf.startswith(_RPM_PREFIX, start, end):
+            infix = buf.find(_RPM_INFIX, start, end)
+            try:
+                return (RPM, float(buf[infix + len(_RPM_INFIX):end]), int(buf[start + len(_RPM_PREFIX):infix]))
+            except ValueError:
+                pass
+        elif end - start == len(BUTTON_RELEASED) and buf.startswith(_BUTTON_RELEASED_BYTES, start, end):
+            return (BUTTON_RELEASED,)
+        elif end - start == len(BUTTON_PRESSED) and buf.startswith(_BUTTON_PRESSED_BYTES, start, end):
+            return (BUTTON_PRESSED,)
+        return (TEXT, bytes(buf[start:end]))
+
+    @staticmethod
+    def _decode_frame(frame_type, buf, offset, length):
+        if frame_type == FRAME_RPM and length == _RPM_STRUCT.size:
+            rpm, interval = _RPM_STRUCT.unpack_from(buf, offset)
+            return (RPM, rpm, interval)
+        if frame_type == FRAME_BUTTON and length == 1:
+            return (BUTTON_PRESSED,) if buf[offset] else (BUTTON_RELEASED,)
+        if frame_type == FRAME_WINDOW and length == _UINT16_STRUCT.size:
+            return (WINDOW, _UINT16_STRUCT.unpack_from(buf, offset)[0])
+        if frame_type == FRAME_COUNTS and length == _COUNTS_STRUCT.size:
+            return (COUNTS, *_COUNTS_STRUCT.unpack_from(buf, offset))
+        return None
+
+
+class SerialReader():
+    """Reads everything the serial port has available with a single syscall straight into a reusable buffer and parses
+    it in place, so no bytes-object is allocated per read or per line. Call read_events() whenever fileno() is readable
+    (the port is opened non-blocking by pyserial), it returns the batch of all events that are complete by now.
+    If a trace (trace_util.TraceRecorder) is given, everything that is read is recorded into it."""
+
+    def __init__(self, ser, parser=None, buffer_size=4096, trace=None):
+        self.ser = ser
+        self.trace = trace
+        self.parser = parser or SerialParser()
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+        self.reads = 0
+        self.bytes_read = 0
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    def read_events(self):
+        n = self._readinto(self._view[self._filled:])
+        if self.trace and n:
+            self.trace.write(self._view[self._filled:self._filled + n])
+        self.reads += 1
+        self.bytes_read += n
+        self._filled += n
+        events, consumed = self.parser.parse(self._buffer, 0, self._filled)
+        rest = self._filled - consumed
+        if consumed and rest:  # move the incomplete message to the front, at most MAX_LINE bytes
+            self._buffer[:rest] = self._view[consumed:self._filled]
+        self._filled = rest
+        return events
+
+    def _readinto(self, view):
+        if not hasattr(os, "readv"):  # windows
+            return self.ser.readinto(view[:self.ser.in_waiting or 1])
+        try:
+            n = os.readv(self.ser.fileno(), [view])
+        except BlockingIOError:
+            return 0
+        if n == 0:
+            # same as what pyserial's read() does in this case
+            raise SerialException("device reports readiness to read but returned no data (device disconnected or multiple access on port?)")
+        return n
@@ -2,10 +2,79 @@ import os
 
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "musik"))
-SONGS_JSON = os.path.join(os.path.basename(__file__), "songs.json")
+SONGS_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "songs.json")
+
+SERIAL_PORT = None  # None: the first /dev/ttyUSB*, or eg. the pty of `python trace_util.py replay ...`
+SERIAL_TRACE = None  # a path to record everything from the serial port into, see trace_util.py
+# serve counters, gauges and histograms in the Prometheus text format (metrics_util.py) on "host:port" or a Unix socket
+METRICS_ADDRESS = None  # eg. "127.0.0.1:9456" or "/tmp/leierkasten-metrics.sock"
+# record a timeline of all threads (timeline_util.py) and write it there as Chrome trace JSON on exit and on SIGUSR1
+TIMELINE_TRACE = None  # eg. "/tmp/leierkasten-timeline.json"
+
+# library_util.LibraryWatcher: songs added to BASE_DIR while running are picked up after no changes happened for
+# LIBRARY_DEBOUNCE_SECONDS. Without inotify, the library is re-scanned every LIBRARY_POLL_SECONDS.
+LIBRARY_DEBOUNCE_SECONDS = 2
+LIBRARY_POLL_SECONDS = 30
+# if the length of a song is known (library_util.extract_metadata), the next one is only queued this long before its end.
+# PLAYER = "mplayer-idle" can't take back a queued song, so it isn't queued at all while the library is watched
+PRELOAD_BEFORE_END_SECONDS = 10
+
+PLAYER = "mplayer-idle"  # one mplayer for all songs. "mplayer" starts a new process for every song, "engine" plays in-process (audio_util)
+# mplayer's stdout and stderr are read all the time (slave_util.OutputDrain), the last PLAYER_OUTPUT_LINES lines of both
+# are kept to be printed when something goes wrong
+PLAYER_OUTPUT_LINES = 200
+# commands to mplayer are written by a thread of their own (slave_util.CommandWriter), from a queue of at most
+# PLAYER_COMMAND_QUEUE_SIZE. A speed_set that couldn't be written within SPEED_COMMAND_DEADLINE_SECONDS is dropped.
+PLAYER_COMMAND_QUEUE_SIZE = 64
+SPEED_COMMAND_DEADLINE_SECONDS = 0.25
+
+# audio_util.AudioEngine: speed changes take effect after at most one block. ENGINE_SINK is "alsa", "null" or "wav:<path>"
+ENGINE_BLOCK_MS = 10
+ENGINE_SAMPLE_RATE = 44100
+ENGINE_SINK = "alsa"
+# every song is decoded once into raw PCM in there (None to disable), the least recently played ones are evicted first
+PCM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "leierkasten", "pcm")
+PCM_CACHE_BUDGET_MB = 4096
+# optionally, every cached song is also pre-rendered at these speeds in the background, and the engine plays the closest
+# one with a short crossfade instead of resampling while playing. Eg. [0.5, 0.625, 0.75, 0.875, 1, 1.125, 1.25, 1.5, 1.75]
+ENGINE_SPEED_VARIANTS = None
+ENGINE_VARIANT_TOLERANCE = 0.02  # a variant is only played if it is this close to the wanted speed, else it's resampled
+PCM_VARIANT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "leierkasten", "variants")
+PCM_VARIANT_BUDGET_MB = 16384
+VARIANT_WORKERS = max(1, (os.cpu_count() or 1) - 1)
 
 
 SPEED_FACTOR = 0.25 # if 20 RPM is default speed, then with a SPEED_FACTOR=1 40 RPM would be 2x default. With SPEED_FACTOR=0.5, 40 RPM -> 1.5x default
 # FROM DONE: die sensibilität einstellen können - dass der nen bisschen disktretisiert bzw ne abschwächende kurve über
 #        die tatsächliche drehgeschwindigkeit liegt sodass nicht nur exakt 20RPM 1x speed sind und 30RPM schon 1.5x...
-#        -> letztlich einfach nur: "doppelt so schnell drehen heißt NICHT doppelt so schnell abspielen, sondern nen faktor."
\ No newline at end of file
+#        -> letztlich einfach nur: "doppelt so schnell drehen heißt NICHT doppelt so schnell abspielen, sondern nen faktor."
+
+# rpm_util.RpmEstimator, used when the firmware sends raw encoder counts (RAW_COUNTS in main.cpp): "ewma", "alpha-beta"
+# or "kalman", over the last RPM_ESTIMATOR_MIN_STEPS encoder steps but at most RPM_ESTIMATOR_MAX_WINDOW_SECONDS
+RPM_ESTIMATOR = "kalman"
+RPM_ESTIMATOR_MIN_STEPS = 3
+RPM_ESTIMATOR_MAX_WINDOW_SECONDS = 1.5
+STEPS_PER_REVOLUTION = 24
+
+# speed_util.SpeedCurve: how the RPM maps to the speed. SPEED_CURVE is "linear", "exp", "log" or "spline" between the
+# SPEED_CURVE_POINTS, which are (RPM / default RPM, speed) pairs - None is the straight line given by SPEED_FACTOR.
+# Eg. SPEED_CURVE = "spline" with [(0, 0.5), (0.5, 0.8), (1, 1), (2, 1.4), (4, 2)]
+SPEED_CURVE = "linear"
+SPEED_CURVE_POINTS = None
+SPEED_CURVE_MAX_RPM_FACTOR = 10  # cranking faster than 10x the default RPM doesn't make it any faster
+SPEED_CURVE_RESOLUTION_RPM = 0.01
+# only send these speeds to the player: None, a step like 0.05, or a list (eg. ENGINE_SPEED_VARIANTS)
+SPEED_QUANTIZE = None
+
+# speed_util.SpeedController: only send a `speed_set` if the speed changed by at least SPEED_DEADBAND (plus
+# SPEED_HYSTERESIS if it changes direction), and never more than SPEED_MAX_COMMANDS_PER_SECOND.
+SPEED_DEADBAND = 0.02
+SPEED_HYSTERESIS = 0.01
+SPEED_MAX_COMMANDS_PER_SECOND = 10
+
+# loudness_util: songs get a gain that brings them to LOUDNESS_TARGET_LUFS, limited so their peak stays below
+# LOUDNESS_MAX_PEAK_DBFS. It is computed offline and applied when a song starts (player volume or engine gain).
+LOUDNESS_TARGET_LUFS = -16
+LOUDNESS_MAX_PEAK_DBFS = -1
+LOUDNESS_ANALYSIS = False  # analyse new songs in the background while running, else only with `python loudness_util.py`
+LOUDNESS_WORKERS = 1  # processes for the analysis while running, `python loudness_util.py` uses all cores
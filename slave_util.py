@@ -0,0 +1,349 @@
+"""Talking to mplayer's slave mode both ways: questions like get_time_pos are answered on its stdout with lines like
+`ANS_TIME_POSITION=12.3`, which a SlaveClient turns into the result of the Future that query() returned.
+
+The SlaveClient reads nothing by itself. An OutputDrain, run by the print_mplayer_thread in its select() loop, reads
+both of mplayer's pipes whenever there is something in them - a pipe nobody reads fills up, and then mplayer blocks on
+writing to it. It hands the answers in there to the SlaveClient, tells about the lines it recognises (EVENTS), and keeps
+the last lines of both pipes for when something goes wrong.
+
+Commands go the other way through a CommandWriter: its thread writes them to mplayer's stdin without blocking whoever
+sent them, and drops the ones that waited too long (a speed_set from a second ago is no use anymore).
+
+    player.get_time_pos().add_done_callback(lambda future: print(future.result()))
+    player.get_property("speed").result(timeout=1)
+"""
+
+import os
+import selectors
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+
+from event_util import Waker
+from timeline_util import TRACER
+from settings import PLAYER_OUTPUT_LINES, PLAYER_COMMAND_QUEUE_SIZE
+
+# so that a query doesn't un-pause mplayer, which any other command in slave mode does
+QUERY_PREFIX = "pausing_keep_force"
+# lines of mplayer's output that mean something, and the event OutputDrain.on_event is called with for them
+EVENTS = (
+    (b"EOF code: 1", "ended"),  # -idle with -msglevel global=6: the song played through. A process per song exits instead
+    (b"Failed to open", "failed"),
+    (b"Cannot open file", "failed"),
+)
+MAX_LINE_BYTES = 4096  # longer lines (or output without any newline) are cut there
+
+
+class SlaveError(Exception):
+    """mplayer answered with ANS_ERROR, or not at all"""
+
+
+class CommandDropped(Exception):
+    """the CommandWriter did not send a command - it passed its deadline, or the queue was full"""
+
+
+class SlaveClient():
+    """Matches the answers on mplayer's stdout to the queries sent before, in order: mplayer handles its commands one
+    after the other, so the oldest pending query is the one being answered - several can be on their way at once.
+    An answer for a later query means mplayer ignored the ones before it (get_time_pos while nothing plays isn't
+    answered at all), so these fail with a SlaveError, as do all pending ones on reset(). Answers carry no id, so if an
+    ignored query is followed by one of the same kind, the answer goes to the older of the two."""
+
+    def __init__(self, send):
+        self.send = send  # writes one command line to mplayer
+        self._pending = deque()  # (key of the expected answer, Future)
+        self._lock = threading.Lock()  # for _pending - never held while sending, as send() may well call reset()
+        # held while a query is queued and sent, so that the order of _pending is the order in which the queries were
+        # sent. Reentrant, because the callbacks of the queries that reset() fails may send the next one right away
+        self._send_lock = threading.RLock()
+        self._sending = None  # the Future of the query being sent right now
+        self.answers = 0
+
+    def query(self, command, key):
+        """sends command and returns a Future for the value of the ANS_<key>= answer, as a string"""
+        future = Future()
+        with self._send_lock:
+            with self._lock:
+                self._pending.append((key, future))
+            previous, self._sending = self._sending, future
+            try:
+                self.send(f"{QUERY_PREFIX} {command}", on_failure=lambda line, error: self._failed(future, error))
+            except BaseException:
+                self._remove(future)
+                raise
+            finally:
+                self._sending = previous
+        return future
+
+    def _remove(self, future):
+        with self._lock:
+            self._pending = deque(i for i in self._pending if i[1] is not future)
+
+    def _failed(self, future, error):
+        """the query never reached mplayer"""
+        self._remove(future)
+        if not future.done():
+            future.set_exception(error)
+
+    def get_time_pos(self):
+        return self._as_float(self.query("get_time_pos", "TIME_POSITION"))
+
+    def get_time_length(self):
+        return self._as_float(self.query("get_time_length", "LENGTH"))
+
+    def get_property(self, name):
+        return self.query(f"get_property {name}", name)
+
+    @staticmethod
+    def _as_float(future):
+        result = Future()
+
+        def done(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+            try:
+                result.set_result(float(future.result()))
+            except ValueError:
+                result.set_exception(SlaveError(f"not a number: {future.result()}"))
+        future.add_done_callback(done)
+        return result
+
+    def handle_line(self, line):
+        """returns whether line was an answer"""
+        if not line.startswith(b"ANS_"):
+            return False
+        key, _, value = line[4:].rstrip(b"\r").decode("utf8", errors="replace").partition("=")
+        value = value.strip("'")
+        self.answers += 1
+        TRACER.instant("answer", key=key)
+        unanswered, answered = [], None
+        with self._lock:
+            while self._pending:
+                expected, future = self._pending.popleft()
+                if key == expected or key == "ERROR":
+                    answered = future
+                    break
+                unanswered.append((expected, future))
+        # the futures' callbacks run outside of the lock, they may well send the next query
+        for expected, future in unanswered:
+            future.set_exception(SlaveError(f"{expected}: no answer"))
+        if answered is None:
+            print(f"Unexpected answer from mplayer: {line}")
+        elif key == "ERROR":
+            answered.set_exception(SlaveError(f"{expected}: {value}"))
+        else:
+            answered.set_result(value)
+        return True
+
+    def reset(self):
+        """the mplayer process changed - nothing pending will be answered anymore, except the query that is being sent
+        right now: it goes to the new process (sending it may well be what started that)"""
+        with self._lock:
+            pending = deque(i for i in self._pending if i[1] is not self._sending)
+            self._pending = deque(i for i in self._pending if i[1] is self._sending)
+        for key, future in pending:
+            future.set_exception(SlaveError(f"{key}: mplayer was restarted"))
+
+    def pending(self):
+        return len(self._pending)
+
+
+class OutputDrain():
+    """Reads stdout and stderr of the player's current process through the selector of the thread it is called from.
+    Memory stays bounded however long mplayer talks: of every stream only the last `lines` lines are kept, and a
+    line is cut after MAX_LINE_BYTES."""
+
+    def __init__(self, selector, slave=None, on_event=None, lines=PLAYER_OUTPUT_LINES):
+        self.selector = selector
+        self.slave = slave
+        self.on_event = on_event  # called with (event, line) for the lines in EVENTS
+        self.tails = {"stdout": deque(maxlen=lines), "stderr": deque(maxlen=lines)}
+        self.process = None
+        self._partial = {}  # fd -> bytearray of the line read so far
+        self.bytes_read = 0
+
+    def follow(self, process):
+        """from now on reads the pipes of process instead of those of the last one"""
+        if process is self.process:
+            return
+        for fd in list(self._partial):
+            self._close(fd)
+        self.process = process
+        for name in ("stdout", "stderr"):
+            pipe = getattr(process, name, None) if process else None
+            if pipe:
+                self.selector.register(pipe.fileno(), selectors.EVENT_READ, name)
+                self._partial[pipe.fileno()] = bytearray()
+
+    def read(self, key):
+        """for a selector key that is ready, as registered by follow()"""
+        fd, name = key.fd, key.data
+        chunk = os.read(fd, 65536)
+        if not chunk:  # EOF - the process exited
+            self._close(fd)
+            return
+        self.bytes_read += len(chunk)
+        partial = self._partial[fd]
+        partial += chunk
+        *lines, rest = partial.split(b"\n")
+        if len(rest) > MAX_LINE_BYTES:
+            lines.append(rest[:MAX_LINE_BYTES])
+            rest = b""
+        self._partial[fd] = bytearray(rest)
+        for line in lines:
+            self._handle(name, bytes(line[:MAX_LINE_BYTES].rstrip(b"\r")))
+
+    def _handle(self, name, line):
+        if name == "stdout" and self.slave and self.slave.handle_line(line):
+            return
+        self.tails[name].append(line)
+        for pattern, event in EVENTS:
+            if pattern in line:
+                if self.on_event:
+                    self.on_event(event, line)
+                break
+
+    def _close(self, fd):
+        self.selector.unregister(fd)
+        del self._partial[fd]
+
+    def tail(self, name="stderr", n=20):
+        """the last n lines of stdout or stderr, as text"""
+        return [line.decode("utf8", errors="replace") for line in list(self.tails[name])[-n:]]
+
+
+class CommandWriter():
+    """Writes command lines to a pipe from its own thread, in the order they were submit()ted, with non-blocking
+    writes: while the pipe is full it waits in select() until the command's deadline, and drops it after that. A
+    command with a key replaces the one with the same key that is still waiting, so of several speed_sets only the
+    newest is sent. Commands that could not be sent are reported to on_failure(line, error) from the writer's thread -
+    submit() itself never blocks and never raises. Neither does stop(), even if mplayer hangs and never reads: the
+    command being written then is dropped, and so is everything still queued."""
+
+    def __init__(self, on_failure=None, capacity=PLAYER_COMMAND_QUEUE_SIZE, name="player_writer"):
+        self.on_failure = on_failure
+        self.capacity = capacity
+        self._queue = deque()  # [line, deadline, key, on_failure]
+        self._failures = deque()  # (line, error, on_failure) to be reported from the writer's thread
+        self._condition = threading.Condition()
+        self._pipe = None  # kept, so that its fd isn't closed and reused while something might still be written to it
+        self._writing = False
+        self._stopped = False
+        self._waker = Waker()  # wakes up a write that waits for the pipe when the writer is stopped
+        self.stats = {"written": 0, "replaced": 0, "expired": 0, "full": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def attach(self, pipe):
+        """writes to pipe (eg. a new process' stdin) from now on, including what is still queued"""
+        os.set_blocking(pipe.fileno(), False)
+        with self._condition:
+            self._pipe = pipe
+            self._condition.notify_all()
+
+    def submit(self, line, deadline=None, key=None, on_failure=None):
+        """queues line to be written, unless it is still waiting at the monotonic() time deadline"""
+        with self._condition:
+            if key is not None:
+                # the replaced one goes, the new one is queued at the end - so it still comes after everything that
+                # was submitted in between, eg. a loadfile which resets mplayer's speed
+                for command in self._queue:
+                    if command[2] == key:
+                        self._queue.remove(command)
+                        self.stats["replaced"] += 1
+                        break
+            if len(self._queue) >= self.capacity:
+                self.stats["full"] += 1
+                self._failures.append((line, CommandDropped("the command queue is full"), on_failure))
+            else:
+                self._queue.append([line, deadline, key, on_failure])
+            self._condition.notify_all()
+
+    def reject(self, line, error, on_failure=None):
+        """reports that line could not even be queued, from the writer's thread like every other failure - so that the
+        caller may well hold a lock that on_failure takes"""
+        with self._condition:
+            self._failures.append((line, error, on_failure))
+            self._condition.notify_all()
+
+    def qsize(self):
+        return len(self._queue)
+
+    def flush(self, timeout=None):
+        """waits until everything queued so far is written (or dropped), returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._failures and not self._writing,
+                                            timeout)
+
+    def stop(self):
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._condition.notify_all()
+        self._waker.wake()
+        self._thread.join()
+        self._waker.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or self._failures
+                                         or (self._queue and self._pipe is not None))
+                failures, self._failures = self._failures, deque()
+                if failures:
+                    self._writing = True
+                elif self._stopped:
+                    return
+                else:
+                    line, deadline, key, on_failure = self._queue.popleft()
+                    pipe = self._pipe
+                    self._writing = True
+            if failures:
+                for line, error, on_failure in failures:
+                    self._report(line, error, on_failure)
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+                continue
+            try:
+                self._write(pipe.fileno(), line, deadline)
+            except (CommandDropped, OSError) as e:
+                self.stats["expired" if isinstance(e, CommandDropped) else "failed"] += 1
+                self._report(line, e, on_failure)
+            else:
+                self.stats["written"] += 1
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def _write(self, fd, line, deadline):
+        data = line.encode("utf8") + b"\n"
+        view = memoryview(data)
+        with TRACER.span("command", line=line):
+            while view:
+                # once it is partly written it has to be finished, or the next command would be garbled
+                timeout = deadline - monotonic() if deadline is not None and len(view) == len(data) else None
+                if timeout is not None and timeout <= 0:
+                    raise CommandDropped("its deadline passed before mplayer read it")
+                try:
+                    view = view[os.write(fd, view):]
+                    continue
+                except BlockingIOError:
+                    pass
+                with selectors.DefaultSelector() as selector:
+                    selector.register(fd, selectors.EVENT_WRITE)
+                    selector.register(self._waker, selectors.EVENT_READ)
+                    selector.select(timeout)
+                if self._stopped:
+                    raise CommandDropped("the writer was stopped before mplayer read it")
+
+    def _report(self, line, error, on_failure):
+        TRACER.instant("command failed", line=line, error=repr(error))
+        callback = on_failure or self.on_failure
+        if callback:
+            callback(line, error)
+        else:
+            print(f"Command {line!r} failed: {error!r}")
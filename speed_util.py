@@ -0,0 +1,212 @@
+"""Everything between the crank's RPM and the speed that is sent to the player."""
+
+from time import monotonic
+
+import numpy as np
+
+from settings import SPEED_FACTOR, SPEED_DEADBAND, SPEED_HYSTERESIS, SPEED_MAX_COMMANDS_PER_SECOND, SPEED_CURVE, \
+    SPEED_CURVE_POINTS, SPEED_CURVE_MAX_RPM_FACTOR, SPEED_CURVE_RESOLUTION_RPM, SPEED_QUANTIZE
+
+CURVE_KINDS = ("linear", "exp", "log", "spline")
+
+
+def _interpolate(x, px, py):
+    """piecewise linear through the points, continued linearly with the outer segments beyond them"""
+    y = np.interp(x, px, py)
+    below, above = x < px[0], x > px[-1]
+    y[below] = py[0] + (x[below] - px[0]) * (py[1] - py[0]) / (px[1] - px[0])
+    y[above] = py[-1] + (x[above] - px[-1]) * (py[-1] - py[-2]) / (px[-1] - px[-2])
+    return y
+
+
+def _monotone_spline(x, px, py):
+    """monotone cubic Hermite spline (Fritsch-Carlson) through the points, so it never overshoots between two of them,
+    continued linearly with the end slopes"""
+    h = np.diff(px)
+    secants = np.diff(py) / h
+    slopes = np.empty_like(py)
+    slopes[0], slopes[-1] = secants[0], secants[-1]
+    slopes[1:-1] = (secants[:-1] + secants[1:]) / 2
+    for k, secant in enumerate(secants):
+        if secant == 0:
+            slopes[k] = slopes[k + 1] = 0
+        elif slopes[k] / secant > 3 or slopes[k + 1] / secant > 3 or slopes[k] / secant < 0 or slopes[k + 1] / secant < 0:
+            slopes[k] = min(max(slopes[k] / secant, 0), 3) * secant
+            slopes[k + 1] = min(max(slopes[k + 1] / secant, 0), 3) * secant
+    k = np.clip(np.searchsorted(px, x) - 1, 0, len(h) - 1)
+    t = np.clip((x - px[k]) / h[k], 0, 1)
+    y = ((2 * t ** 3 - 3 * t ** 2 + 1) * py[k] + (t ** 3 - 2 * t ** 2 + t) * h[k] * slopes[k]
+         + (-2 * t ** 3 + 3 * t ** 2) * py[k + 1] + (t ** 3 - t ** 2) * h[k] * slopes[k + 1])
+    below, above = x < px[0], x > px[-1]
+    y[below] = py[0] + (x[below] - px[0]) * slopes[0]
+    y[above] = py[-1] + (x[above] - px[-1]) * slopes[-1]
+    return y
+
+
+class SpeedCurve():
+    """Maps the crank's RPM to the player's speed, compiled once into a dense table so that every call is a single
+    list lookup.
+
+    * kind: how to get from one control point to the next - "linear", "exp" (exponential, linear in log(speed)), "log"
+      (logarithmic, linear in log(1 + rpm factor)) or "spline" (a monotone cubic spline through all points)
+    * points: (rpm factor, speed) control points, where the rpm factor is rpm / rpm_for_1. Beyond the outer points the
+      curve continues with the outer slopes. By default, the straight line through (1, 1) with slope SPEED_FACTOR.
+    * max_rpm_factor: above rpm_for_1 * max_rpm_factor the speed doesn't grow any further
+    * resolution: RPM between two entries of the table
+    * quantize: None, a step (eg. 0.05 to only send multiples of 0.05) or a list of the only speeds to send
+
+    0 RPM (or less) is always speed 0."""
+
+    def __init__(self, rpm_for_1, kind=SPEED_CURVE, points=SPEED_CURVE_POINTS, max_rpm_factor=SPEED_CURVE_MAX_RPM_FACTOR,
+                 resolution=SPEED_CURVE_RESOLUTION_RPM, quantize=SPEED_QUANTIZE):
+        if kind not in CURVE_KINDS:
+            raise ValueError(f"Unknown speed curve {kind!r}, must be one of {', '.join(CURVE_KINDS)}")
+        if points is None:
+            points = [(0, 1 - SPEED_FACTOR), (1, 1), (2, 1 + SPEED_FACTOR)]
+        px, py = (np.array(i, dtype=np.float64) for i in zip(*sorted(points)))
+        if len(px) < 2 or np.any(np.diff(px) <= 0):
+            raise ValueError("A speed curve needs at least two control points with different rpm factors")
+        self.rpm_for_1 = rpm_for_1
+        self.kind = kind
+        self.points = list(zip(px.tolist(), py.tolist()))
+        self._scale = 1 / resolution
+        self.max_rpm = rpm_for_1 * max_rpm_factor
+        x = np.arange(int(self.max_rpm * self._scale) + 1) * resolution / rpm_for_1
+        if kind == "linear":
+            speeds = _interpolate(x, px, py)
+        elif kind == "exp":
+            if np.any(py <= 0):
+                raise ValueError("An exponential speed curve needs speeds above 0 at all control points")
+            speeds = np.exp(_interpolate(x, px, np.log(py)))
+        elif kind == "log":
+            if np.any(px < 0):
+                raise ValueError("A logarithmic speed curve needs rpm factors of at least 0")
+            speeds = _interpolate(np.log1p(x), np.log1p(px), py)
+        else:
+            speeds = _monotone_spline(x, px, py)
+        speeds = np.maximum(speeds, 0)
+        if quantize is not None:
+            if np.ndim(quantize):
+                allowed = np.sort(np.asarray(quantize, dtype=np.float64))
+                nearest = np.clip(np.searchsorted(allowed, speeds), 1, len(allowed) - 1)
+                speeds = np.where(speeds - allowed[nearest - 1] < allowed[nearest] - speeds,
+                                  allowed[nearest - 1], allowed[nearest])
+            else:
+                speeds = np.round(speeds / quantize) * quantize
+            speeds = np.round(speeds, 6)  # so that equal steps come out as equal floats
+        speeds[0] = 0
+        self._table = speeds.tolist()
+        self._last = len(self._table) - 1
+
+    def __call__(self, rpm):
+        if rpm <= 0:
+            return 0
+        index = int(rpm * self._scale + 0.5)
+        return self._table[index if index < self._last else self._last]
+
+    def speeds(self):
+        """all speeds the curve can return, sorted"""
+        return sorted(set(self._table))
+
+
+class SpeedController():
+    """Decides which speeds are actually worth a `speed_set` to the player.
+
+    * deadband: speeds that differ from the last sent one by less than this (an absolute difference, not a ratio) are
+      suppressed
+    * hysteresis: when the speed changes direction compared to the last sent change, it has to move by
+      deadband + hysteresis, so that a jittery crank doesn't flip between two values
+    * max_rate: at most this many commands per second. A meaningful change that comes too early is not dropped but
+      kept as pending - the caller should call update() again after retry_in() seconds.
+
+    send is called with the speed whenever a command should go out."""
+
+    def __init__(self, send, deadband=SPEED_DEADBAND, hysteresis=SPEED_HYSTERESIS,
+                 max_rate=SPEED_MAX_COMMANDS_PER_SECOND, clock=monotonic):
+        self.send = send
+        self.deadband = deadband
+        self.hysteresis = hysteresis
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.clock = clock
+        self.last_sent = None
+        self.last_sent_time = None
+        self.pending = None
+        self._last_direction = 0
+        self._last_input = None
+        self.sent = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+
+    def invalidate(self):
+        """the player forgot its speed (eg. a new song started), so the next update is sent no matter what"""
+        self.last_sent = None
+        self.last_sent_time = None
+
+    def update(self, speed):
+        """returns True if the speed was sent. Called on every wakeup of the playback_thread, so only a speed that
+        differs from the one passed before counts as suppressed"""
+        previous, self._last_input = self._last_input, speed
+        if self.last_sent is not None:
+            delta = speed - self.last_sent
+            threshold = self.deadband
+            if self._last_direction and (delta > 0) != (self._last_direction > 0):
+                threshold += self.hysteresis
+            if abs(delta) < threshold:
+                self.pending = None
+                if speed != previous:
+                    self.suppressed += 1
+                return False
+            if self.clock() - self.last_sent_time < self.min_interval:
+                if self.pending is None:
+                    self.rate_limited += 1
+                self.pending = speed
+                return False
+            self._last_direction = delta
+        self.send(speed)
+        self.last_sent = speed
+        self.last_sent_time = self.clock()
+        self.pending = None
+        self.sent += 1
+        return True
+
+    def retry_in(self):
+        """seconds until update() should be called again, or None if nothing is waiting to be sent"""
+        if self.last_sent is None:
+            return 0
+        if self.pending is None:
+            return None
+        return max(0, self.last_sent_time + self.min_interval - self.clock())
+
+    def stats(self):
+        return {"sent": self.sent, "suppressed": self.suppressed, "rate_limited": self.rate_limited}
+
+
+class PlaybackClock():
+    """Estimates how far into the current song the player is, from the speeds that were sent to it."""
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.start()
+
+    def start(self, speed=1.0):
+        self._position = 0.0
+        self._since = self.clock()
+        self._speed = speed
+
+    def set_speed(self, speed):
+        self._position = self.position()
+        self._since = self.clock()
+        self._speed = speed
+
+    def position(self):
+        """seconds into the song"""
+        return self._position + (self.clock() - self._since) * self._speed
+
+    def seconds_until(self, position):
+        """real seconds until the song reaches position at the current speed, None if it never will"""
+        remaining = position - self.position()
+        if remaining <= 0:
+            return 0
+        if self._speed <= 0:
+            return None
+        return remaining / self._speed
@@ -0,0 +1,110 @@
+"""An opt-in timeline of what all threads are doing, as Chrome trace-event JSON (chrome://tracing or ui.perfetto.dev).
+
+Every thread appends its events to its own bounded deque, so recording takes no lock - an append is atomic and there
+is only ever one writer per deque. The deques are only read together when dump() is called. With settings.TIMELINE_TRACE
+set to a path, main() enables the TRACER and dumps it there on exit and whenever it gets a SIGUSR1:
+
+    kill -USR1 $(pgrep -f main.py)
+
+When the TRACER is disabled, span() and instant() return right away, so the calls can stay in the code.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter
+
+from settings import TIMELINE_TRACE
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span():
+    __slots__ = ("buffer", "name", "args", "start")
+
+    def __init__(self, buffer, name, args):
+        self.buffer = buffer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.buffer.append(("X", self.name, self.start, perf_counter() - self.start, self.args))
+
+
+class Tracer():
+    """Records spans (`with tracer.span("name"):`) and instant events, each thread into its own buffer of at most
+    events_per_thread events - the oldest are dropped first."""
+
+    def __init__(self, enabled=False, events_per_thread=100000):
+        self.enabled = enabled
+        self.events_per_thread = events_per_thread
+        self._origin = perf_counter()
+        self._local = threading.local()
+        self._buffers = []  # (native thread id, thread name, deque)
+        self._register_lock = threading.Lock()  # only taken for the first event of every thread
+
+    def _buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            buffer = self._local.buffer = deque(maxlen=self.events_per_thread)
+            with self._register_lock:
+                self._buffers.append((threading.get_native_id(), threading.current_thread().name, buffer))
+            return buffer
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self._buffer(), name, args)
+
+    def instant(self, name, **args):
+        if self.enabled:
+            self._buffer().append(("i", name, perf_counter(), 0, args))
+
+    def complete(self, name, start, duration, **args):
+        """a span that was measured elsewhere, start in perf_counter() seconds"""
+        if self.enabled:
+            self._buffer().append(("X", name, start, duration, args))
+
+    def events(self):
+        """everything recorded so far, as trace-event dicts"""
+        pid = os.getpid()
+        with self._register_lock:
+            buffers = list(self._buffers)
+        events = []
+        for tid, thread_name, buffer in buffers:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}})
+            for phase, name, start, duration, args in buffer.copy():  # copy() runs without releasing the GIL
+                event = {"name": name, "ph": phase, "ts": (start - self._origin) * 1e6, "pid": pid, "tid": tid}
+                if phase == "X":
+                    event["dur"] = duration * 1e6
+                else:
+                    event["s"] = "t"
+                if args:
+                    event["args"] = args
+                events.append(event)
+        return events
+
+    def dump(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as wfile:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, wfile)
+        os.replace(tmp_path, path)
+        print(f"Timeline written to {path}")
+
+
+TRACER = Tracer(enabled=bool(TIMELINE_TRACE))
@@ -0,0 +1,221 @@
+"""Recording what came over the serial port, and playing it back through a pseudo-terminal.
+
+A trace is everything the arduino sent, in the chunks it arrived in, each with the time since the previous one:
+
+    header: b"LKTRC\\x01" | uint64 wall-clock ns at the start of the recording
+    record: uint32 µs since the previous record | uint16 length | the bytes
+
+Appending to a trace (what the Leierkasten does, so that a restart doesn't overwrite the session before it) starts a
+new segment with a header of its own. No record ever looks like a header or contains one, so a record that was cut off
+(the Leierkasten usually stops by losing its power) is recognised by the header of the next segment inside of it.
+
+The TraceReplayer writes a trace into a pty in real time or N times faster, and its `port` (/dev/pts/N) is a serial
+port like any other, so `Leierkasten(serial_port=replayer.port)` (or settings.SERIAL_PORT) runs against it unchanged.
+
+    python trace_util.py record out.trace [/dev/ttyUSB0]   # until Ctrl-C, or set settings.SERIAL_TRACE
+    python trace_util.py replay out.trace [--speed 10] [--loop]
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import threading
+import tty
+from time import monotonic_ns, sleep, time_ns
+
+TRACE_MAGIC = b"LKTRC\x01"
+TRACE_HEADER = struct.Struct("<6sQ")
+TRACE_RECORD = struct.Struct("<IH")
+MAX_DELAY_US = 0xFFFFFFFF
+MAX_CHUNK = 0xFFFF
+
+
+class TraceRecorder():
+    """Appends every chunk passed to write() to a trace file, timestamped with the monotonic clock, and flushes it right
+    away. With append, an existing trace at path is continued with a new segment instead of being overwritten."""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._file = open(path, "ab" if append else "wb")
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, time_ns()))
+        self._file.flush()
+        self._last = monotonic_ns()
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def write(self, data):
+        now = monotonic_ns()
+        with self._lock:
+            if self._file.closed:
+                return
+            delay = (now - self._last) // 1000
+            self._last = now
+            while delay > MAX_DELAY_US:
+                self._file.write(TRACE_RECORD.pack(MAX_DELAY_US, 0))
+                delay -= MAX_DELAY_US
+            for chunk in _chunks(data):
+                if TRACE_RECORD.pack(delay, len(chunk)) == TRACE_MAGIC:  # would be read as the start of a segment
+                    self._file.write(TRACE_RECORD.pack(delay, 0))
+                    delay = 0
+                self._file.write(TRACE_RECORD.pack(delay, len(chunk)))
+                self._file.write(chunk)
+                delay = 0
+            self._file.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _chunks(data):
+    """data in pieces of at most MAX_CHUNK bytes, cut in the middle of everything that looks like a segment header"""
+    start = 0
+    while start < len(data):
+        end = min(start + MAX_CHUNK, len(data))
+        magic = data.find(TRACE_MAGIC, start, end + len(TRACE_MAGIC) - 1)
+        if magic != -1:
+            end = min(end, magic + 1)
+        yield data[start:end]
+        start = end
+
+
+def read_trace(path):
+    """yields (seconds since the start of the recording, bytes) for every record of the trace at path. Later segments
+    start as long after the first one as they did on the wall-clock, but never before the previous one ended. A record
+    that was cut off is skipped: at the end of the file, or where the next segment starts inside of it."""
+    with open(path, "rb") as rfile:
+        if os.fstat(rfile.fileno()).st_size < TRACE_HEADER.size:
+            raise ValueError(f"{path} is not a serial trace")
+        with mmap.mmap(rfile.fileno(), 0, access=mmap.ACCESS_READ) as trace:
+            magic, first_start_ns = TRACE_HEADER.unpack_from(trace)
+            if magic != TRACE_MAGIC:
+                raise ValueError(f"{path} is not a serial trace")
+            pos, elapsed_us = TRACE_HEADER.size, 0
+            while pos + TRACE_RECORD.size <= len(trace):
+                if trace[pos:pos + len(TRACE_MAGIC)] == TRACE_MAGIC:
+                    if pos + TRACE_HEADER.size > len(trace):
+                        return
+                    _, start_ns = TRACE_HEADER.unpack_from(trace, pos)
+                    elapsed_us = max(elapsed_us, (start_ns - first_start_ns) // 1000)
+                    pos += TRACE_HEADER.size
+                    continue
+                delay, length = TRACE_RECORD.unpack_from(trace, pos)
+                end = pos + TRACE_RECORD.size + length
+                cut = trace.find(TRACE_MAGIC, pos + 1, end + len(TRACE_MAGIC) - 1)
+                if cut != -1:
+                    pos = cut  # the recording stopped in the middle of this record, the next one started there
+                    continue
+                if end > len(trace):
+                    return
+                elapsed_us += delay
+                if length:
+                    yield elapsed_us / 1e6, bytes(trace[pos + TRACE_RECORD.size:end])
+                pos = end
+
+
+class TraceReplayer():
+    """Serves a trace through a new pty at `port`, `speed` times as fast as it was recorded (0 for as fast as
+    possible), starting over at the end if `loop`. Once it is through, the pty stays open (but silent) until stop(),
+    so the reader on the other side doesn't see a disconnect."""
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self._master, self._slave = os.openpty()
+        os.set_blocking(self._master, False)
+        tty.setraw(self._slave)  # no echo and no newline translation, whatever opens it later
+        self.port = os.ttyname(self._slave)
+        self.finished = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.bytes_written = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            start = monotonic_ns()
+            for elapsed, data in read_trace(self.path):
+                if self.speed:
+                    delay = start + elapsed / self.speed * 1e9 - monotonic_ns()
+                    if delay > 0 and self._stopped.wait(delay / 1e9):
+                        return
+                elif self._stopped.is_set():
+                    return
+                self._write(data)
+            if not self.loop:
+                break
+        self.finished.set()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                n = os.write(self._master, view)
+            except BlockingIOError:  # nobody reads the other side right now
+                if self._stopped.wait(0.001):
+                    return
+                continue
+            self.bytes_written += n
+            view = view[n:]
+
+
+def record(path, port, baudrate=115200):
+    import serial
+    ser = serial.Serial(port, baudrate)
+    recorder = TraceRecorder(path)
+    print(f"Recording {port} to {path}, Ctrl-C to stop")
+    try:
+        while True:
+            recorder.write(ser.read(ser.in_waiting or 1))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        ser.close()
+    print(f"{recorder.records} chunks recorded")
+
+
+def replay(path, speed, loop):
+    replayer = TraceReplayer(path, speed, loop).start()
+    print(f"Replaying {path} on {replayer.port}, Ctrl-C to stop")
+    try:
+        while not replayer.finished.wait(1):
+            pass
+        print(f"Done, {replayer.bytes_written} bytes. The port stays open until Ctrl-C")
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        replayer.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record or replay the serial stream of the Leierkasten")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record")
+    record_parser.add_argument("path")
+    record_parser.add_argument("port", nargs="?", default=None, help="the first /dev/ttyUSB* by default")
+    record_parser.add_argument("--baudrate", type=int, default=115200)
+    replay_parser = subparsers.add_parser("replay")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="N times faster, 0 for as fast as possible")
+    replay_parser.add_argument("--loop", action="store_true")
+    args = parser.parse_args()
+    if args.command == "record":
+        port = args.port or "/dev/" + [i for i in os.listdir("/dev") if "ttyUSB" in i][0]
+        record(args.path, port, args.baudrate)
+    else:
+        replay(args.path, args.speed, args.loop)